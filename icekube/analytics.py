@@ -0,0 +1,260 @@
+"""Whole-graph attack path analytics computed outside of neo4j.
+
+The attack path subgraph is exported once into integer indexed CSR arrays, and
+reachability is propagated as bitsets across every node at the same time. This
+requires numpy, which is not installed with IceKube by default.
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import Any, Dict, Iterable, List, Tuple, cast
+
+import numpy as np
+from icekube.neo4j import get_driver, write
+from icekube.reachability import PRINCIPAL_KINDS, reachability_targets
+from neo4j import Session
+
+logger = logging.getLogger(__name__)
+
+# Number of principals or targets propagated at once, bounds memory to roughly
+# edges * CHUNK_BITS / 8 bytes
+CHUNK_BITS = 512
+WRITE_BATCH_SIZE = 10000
+
+
+class AttackGraph:
+    """The attack path subgraph in compressed sparse row form."""
+
+    def __init__(
+        self,
+        node_ids: np.ndarray,
+        src: np.ndarray,
+        dst: np.ndarray,
+        edge_ids: np.ndarray,
+        edge_types: np.ndarray,
+        type_names: List[str],
+    ):
+        self.node_ids = node_ids
+        self.edge_ids = edge_ids
+        self.edge_types = edge_types
+        self.type_names = type_names
+        self.src = src
+        self.dst = dst
+
+        # Outgoing edges, used to find what each node can reach
+        self.indptr, self.indices = csr(src, dst, len(node_ids))
+        # Incoming edges, used to find what can reach each node
+        self.rev_indptr, self.rev_indices = csr(dst, src, len(node_ids))
+
+    def __len__(self) -> int:
+        return len(self.node_ids)
+
+    def index(self, ids: Iterable[int]) -> np.ndarray:
+        """Map neo4j node ids to indexes, dropping nodes outside of the graph."""
+        wanted = np.unique(np.fromiter(ids, dtype=np.int64))
+        if not len(self.node_ids):
+            return np.zeros(0, dtype=np.int64)
+
+        idx = np.searchsorted(self.node_ids, wanted)
+        idx[idx == len(self.node_ids)] = 0
+        return cast(np.ndarray, idx[self.node_ids[idx] == wanted])
+
+
+def csr(src: np.ndarray, dst: np.ndarray, size: int) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(src, kind="stable")
+    indptr = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=size), out=indptr[1:])
+    return indptr, dst[order]
+
+
+def export_attack_graph(session: Session) -> AttackGraph:
+    cmd = (
+        "MATCH (src)-[r]->(dst) WHERE r.attack_path IS NOT NULL "
+        "RETURN id(src), id(dst), id(r), type(r)"
+    )
+    src: List[int] = []
+    dst: List[int] = []
+    edge_ids: List[int] = []
+    edge_types: List[int] = []
+    type_index: Dict[str, int] = {}
+
+    for s, d, r, t in session.run(cmd):
+        src.append(s)
+        dst.append(d)
+        edge_ids.append(r)
+        edge_types.append(type_index.setdefault(t, len(type_index)))
+
+    node_ids, inverse = np.unique(
+        np.concatenate([np.array(src, np.int64), np.array(dst, np.int64)]),
+        return_inverse=True,
+    )
+    inverse = inverse.reshape(-1)
+
+    return AttackGraph(
+        node_ids=node_ids,
+        src=inverse[: len(src)],
+        dst=inverse[len(src) :],
+        edge_ids=np.array(edge_ids, np.int64),
+        edge_types=np.array(edge_types, np.int32),
+        type_names=list(type_index),
+    )
+
+
+def propagate(indptr: np.ndarray, indices: np.ndarray, seeds: np.ndarray) -> np.ndarray:
+    """Flood bitsets across the graph until they stop changing.
+
+    `seeds` holds one row of packed bits per node. On return each row is the OR
+    of its own seeds and the seeds of every node reachable from it.
+    """
+    reach = seeds.copy()
+    rows = np.flatnonzero(np.diff(indptr))
+    if not len(rows):
+        return reach
+
+    starts = indptr[rows]
+    while True:
+        gathered = np.bitwise_or.reduceat(reach[indices], starts, axis=0)
+        updated = reach[rows] | gathered
+        if np.array_equal(updated, reach[rows]):
+            return reach
+        reach[rows] = updated
+
+
+def count_reachable(
+    indptr: np.ndarray,
+    indices: np.ndarray,
+    size: int,
+    seeds: np.ndarray,
+) -> np.ndarray:
+    """Count, for every node, how many of the seed nodes it can reach."""
+    counts = np.zeros(size, dtype=np.int64)
+
+    for offset in range(0, len(seeds), CHUNK_BITS):
+        chunk = seeds[offset : offset + CHUNK_BITS]
+        bits = np.zeros((size, CHUNK_BITS // 8), dtype=np.uint8)
+        bits[chunk, np.arange(len(chunk)) // 8] |= np.left_shift(
+            1, 7 - np.arange(len(chunk)) % 8
+        ).astype(np.uint8)
+
+        reach = propagate(indptr, indices, bits.view(np.uint64))
+        counts += np.unpackbits(reach.view(np.uint8), axis=1).sum(
+            axis=1, dtype=np.int64
+        )
+
+    return counts
+
+
+def node_ids_for(session: Session, query: str) -> List[int]:
+    return cast(List[int], session.run(query).value())
+
+
+def write_properties(cmd: str, rows: List[List[Any]]) -> None:
+    for offset in range(0, len(rows), WRITE_BATCH_SIZE):
+        write(cmd, {"rows": rows[offset : offset + WRITE_BATCH_SIZE]})
+
+
+def describe(session: Session, ids: List[int]) -> Dict[int, str]:
+    from icekube.models import Resource
+
+    cmd = "MATCH (n) WHERE id(n) IN $ids RETURN id(n), n"
+    return {
+        node_id: str(Resource(**node._properties))
+        for node_id, node in session.run(cmd, ids=ids)
+    }
+
+
+def attack_graph_analytics(top: int = 10) -> None:
+    """Compute blast radius and chokepoint scores across the attack graph.
+
+    Every node within the attack graph gets a `blast_radius`, the number of
+    crown-jewel targets it can reach, and a `chokepoint_score`, the number of
+    principal and target pairs connected through it. Attack path relationships
+    are also given a `chokepoint_score` for the pairs connected through them.
+    """
+    with get_driver().session() as session:
+        print("Exporting attack graph")
+        graph = export_attack_graph(session)
+        logger.info(
+            f"Exported {len(graph)} nodes and {len(graph.edge_ids)} attack paths",
+        )
+
+        targets = graph.index(
+            x
+            for query in reachability_targets.values()
+            for x in node_ids_for(session, f"{query} RETURN DISTINCT id(target)")
+        )
+        principal_query = (
+            "MATCH (n) WHERE "
+            + " OR ".join(f"n:{x}" for x in PRINCIPAL_KINDS)
+            + " RETURN id(n)"
+        )
+        principals = graph.index(node_ids_for(session, principal_query))
+
+        print("Calculating blast radius")
+        reachable_targets = count_reachable(
+            graph.indptr, graph.indices, len(graph), targets
+        )
+        print("Calculating chokepoints")
+        reaching_principals = count_reachable(
+            graph.rev_indptr, graph.rev_indices, len(graph), principals
+        )
+
+        is_target = np.zeros(len(graph), dtype=np.int64)
+        is_target[targets] = 1
+        blast_radius = reachable_targets - is_target
+        node_score = reaching_principals * reachable_targets
+        edge_score = reaching_principals[graph.src] * reachable_targets[graph.dst]
+
+        print("Saving analytics")
+        write(
+            "MATCH (n) WHERE n.blast_radius IS NOT NULL "
+            "REMOVE n.blast_radius, n.chokepoint_score"
+        )
+        write_properties(
+            "UNWIND $rows AS row MATCH (n) WHERE id(n) = row[0] "
+            "SET n.blast_radius = row[1], n.chokepoint_score = row[2]",
+            np.stack([graph.node_ids, blast_radius, node_score], axis=1).tolist(),
+        )
+        write_properties(
+            "UNWIND $rows AS row MATCH ()-[r]->() WHERE id(r) = row[0] "
+            "SET r.chokepoint_score = row[1]",
+            np.stack([graph.edge_ids, edge_score], axis=1).tolist(),
+        )
+
+        top_principals = principals[np.argsort(-blast_radius[principals])][:top]
+        top_nodes = np.argsort(-node_score)[:top]
+        top_edges = np.argsort(-edge_score)[:top]
+
+        names = describe(
+            session,
+            graph.node_ids[
+                np.concatenate(
+                    [
+                        top_principals,
+                        top_nodes,
+                        graph.src[top_edges],
+                        graph.dst[top_edges],
+                    ]
+                )
+            ].tolist(),
+        )
+
+    def name(idx: int) -> str:
+        return names.get(int(graph.node_ids[idx]), str(graph.node_ids[idx]))
+
+    print("\nPrincipals with the largest blast radius:")
+    for idx in top_principals:
+        print(f"  {blast_radius[idx]:>8}  {name(idx)}")
+
+    print("\nNodes on the most attack paths:")
+    for idx in top_nodes:
+        print(f"  {node_score[idx]:>8}  {name(idx)}")
+
+    print("\nAttack paths on the most routes:")
+    for idx in top_edges:
+        relationship = graph.type_names[graph.edge_types[idx]]
+        print(
+            f"  {edge_score[idx]:>8}  {name(graph.src[idx])} "
+            f"-[{relationship}]-> {name(graph.dst[idx])}"
+        )
@@ -0,0 +1,97 @@
+"""Compare building resources through validation against the trusted fast path.
+
+Run with `python -m icekube.benchmark`. Synthetic list items are built into
+resources the way `Resource.list` and `icekube load` did before, creating each
+resource through full validation, and through `Resource.from_list_items`.
+"""
+
+from __future__ import annotations
+
+import json
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import typer
+from icekube.models import Resource
+
+# apiVersion, kind and plural of the resources benchmarked
+KINDS = [
+    ("v1", "Pod", "pods"),
+    ("v1", "Secret", "secrets"),
+    ("v1", "ConfigMap", "configmaps"),
+    ("rbac.authorization.k8s.io/v1", "ClusterRole", "clusterroles"),
+]
+
+
+def list_item(apiVersion: str, kind: str, idx: int) -> Dict[str, Any]:
+    return {
+        "apiVersion": apiVersion,
+        "kind": kind,
+        "metadata": {
+            "name": f"{kind.lower()}-{idx}",
+            "namespace": "default",
+            "labels": {"app": f"app-{idx % 10}"},
+            "resourceVersion": str(idx),
+        },
+        "data": {"key": "value"},
+        "spec": {"containers": [{"name": "app", "image": "nginx"}]},
+    }
+
+
+def validated(
+    apiVersion: str,
+    kind: str,
+    plural: str,
+    items: List[Dict[str, Any]],
+    raws: List[str],
+) -> List[Resource]:
+    return [
+        Resource(
+            apiVersion=apiVersion,
+            kind=kind,
+            name=item["metadata"]["name"],
+            namespace=item["metadata"].get("namespace"),
+            plural=plural,
+            raw=raw,
+        )
+        for item, raw in zip(items, raws)
+    ]
+
+
+def trusted(
+    apiVersion: str,
+    kind: str,
+    plural: str,
+    items: List[Dict[str, Any]],
+    raws: List[str],
+) -> List[Resource]:
+    return Resource.from_list_items(apiVersion, kind, plural, items, raws)
+
+
+def measure(
+    build: Callable[..., List[Resource]],
+    data: List[Tuple[str, str, str, List[Dict[str, Any]], List[str]]],
+) -> float:
+    start = time.perf_counter()
+    built = sum(len(build(*x)) for x in data)
+    return built / (time.perf_counter() - start)
+
+
+def main(
+    count: int = typer.Option(20000, help="Number of resources of each kind"),
+    repeat: int = typer.Option(3, help="Number of runs, the best is reported"),
+):
+    data = []
+    for apiVersion, kind, plural in KINDS:
+        items = [list_item(apiVersion, kind, idx) for idx in range(count)]
+        raws = [json.dumps(x, default=str) for x in items]
+        data.append((apiVersion, kind, plural, items, raws))
+
+    print(f"Building {count * len(KINDS)} resources, best of {repeat}")
+    for name, build in [("validated", validated), ("from_list_items", trusted)]:
+        rate = max(measure(build, data) for _ in range(repeat))
+        print(f"  {name:>16}: {rate:>10.0f} resources/s")
+
+
+if __name__ == "__main__":
+    typer.run(main)
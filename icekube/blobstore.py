@@ -0,0 +1,67 @@
+"""A content-addressed store for the raw JSON of resources.
+
+Payloads are compressed and saved under a hash of their contents, so identical
+resources, including those from earlier runs or other clusters, are only stored
+once. The graph then only holds the hash of each payload, as `raw_ref`.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import tempfile
+import zlib
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from icekube.config import config
+
+
+class BlobStore:
+    def __init__(self, path: str):
+        self.path = Path(path)
+
+    def blob_path(self, key: str) -> Path:
+        return self.path / key[:2] / key[2:]
+
+    def put(self, raw: str) -> str:
+        """Save a payload if it is not already stored, returning its key."""
+        data = raw.encode()
+        key = hashlib.blake2b(data, digest_size=16).hexdigest()
+
+        path = self.blob_path(key)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Written elsewhere first, so a partially written blob is never read
+            fd, tmp = tempfile.mkstemp(dir=path.parent)
+            with os.fdopen(fd, "wb") as fs:
+                fs.write(zlib.compress(data))
+            os.replace(tmp, path)
+
+        return key
+
+    def get(self, key: str) -> str:
+        try:
+            return zlib.decompress(self.blob_path(key).read_bytes()).decode()
+        except FileNotFoundError:
+            raise ValueError(f"Raw payload {key} is missing from {self.path}")
+
+
+@lru_cache(maxsize=None)
+def open_blob_store(path: str) -> BlobStore:
+    return BlobStore(path)
+
+
+def raw_store() -> Optional[BlobStore]:
+    """The store raw payloads are kept in, if one is configured."""
+    path = config["raw_store"]
+    return open_blob_store(path) if path else None
+
+
+def store_raw(properties: Dict[str, Any]) -> Dict[str, Any]:
+    """Node properties with the raw payload swapped for a `raw_ref`, if stored."""
+    store = raw_store()
+    if store is None or properties.get("raw") is None:
+        return properties
+    return {**properties, "raw": None, "raw_ref": store.put(properties["raw"])}
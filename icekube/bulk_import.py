@@ -0,0 +1,254 @@
+"""Export resources and relationships as CSV files for `neo4j-admin` import.
+
+Nodes are streamed into one CSV file per label, and relationships into one file
+per relationship type, with the headers `neo4j-admin database import` expects.
+Relationships are resolved in memory rather than through neo4j: resource
+endpoints by their identity, and query endpoints through a NodeIndex of the
+resources seen.
+"""
+
+from __future__ import annotations
+
+import csv
+import logging
+import shlex
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+
+from icekube.blobstore import store_raw
+from icekube.models.base import QUERY_RESOURCE, Resource, ResourceRef
+from icekube.models.clusterrole import ClusterRole
+from icekube.models.clusterrolebinding import ClusterRoleBinding, mock_role
+from icekube.models.role import Role
+from icekube.models.rolebinding import RoleBinding
+from icekube.query_matcher import NodeIndex
+
+logger = logging.getLogger(__name__)
+
+ARRAY_DELIMITER = ";"
+
+
+def column_type(value: Any) -> str:
+    if isinstance(value, bool):
+        return ":boolean"
+    elif isinstance(value, int):
+        return ":long"
+    elif isinstance(value, float):
+        return ":double"
+    elif isinstance(value, list):
+        return ":string[]"
+    return ""
+
+
+def csv_value(value: Any) -> str:
+    if value is None:
+        return ""
+    elif isinstance(value, bool):
+        return "true" if value else "false"
+    elif isinstance(value, list):
+        return ARRAY_DELIMITER.join(csv_value(x) for x in value)
+    return str(value)
+
+
+class AdminImportWriter:
+    """Streams nodes and relationships into `neo4j-admin` import CSV files.
+
+    Resources are written as they are added. Bindings are held back until every
+    role has been seen, and relationships to query endpoints are resolved once
+    all nodes are known, when the writer is closed.
+    """
+
+    def __init__(self, output_dir: str):
+        self.path = Path(output_dir)
+        (self.path / "nodes").mkdir(parents=True, exist_ok=True)
+        (self.path / "relationships").mkdir(parents=True, exist_ok=True)
+
+        self.files: List[IO[str]] = []
+        self.node_files: Dict[Tuple[str, Tuple[str, ...]], Any] = {}
+        self.node_file_names: List[Path] = []
+        self.relationship_files: Dict[str, Any] = {}
+
+        self.nodes = NodeIndex()
+        self.stubs: Dict[str, Union[Resource, ResourceRef]] = {}
+        self.edges: Set[Tuple[str, str, str]] = set()
+        self.query_edges: List[Tuple[str, QUERY_RESOURCE, List[str], bool]] = []
+
+        self.roles: Dict[Tuple[str, Optional[str], str], Union[ClusterRole, Role]] = {}
+        self.bindings: List[Union[ClusterRoleBinding, RoleBinding]] = []
+
+    def __enter__(self) -> AdminImportWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.close_files()
+
+    def open(self, path: Path, header: List[str]) -> Any:
+        fs = open(path, "w", newline="")
+        self.files.append(fs)
+        writer = csv.writer(fs)
+        writer.writerow(header)
+        return writer
+
+    def write_node(
+        self, resource: Union[Resource, ResourceRef], properties: Dict[str, Any]
+    ) -> None:
+        identity = resource.identity
+        if identity in self.nodes:
+            return
+
+        columns = tuple(sorted(properties))
+        key = (resource.kind, columns)
+        if key not in self.node_files:
+            name = resource.kind
+            count = sum(1 for x in self.node_files if x[0] == resource.kind)
+            if count:
+                name += f".{count}"
+            path = self.path / "nodes" / f"{name}.csv"
+            header = ["identity:ID"]
+            header += [x + column_type(properties[x]) for x in columns]
+            header += [":LABEL"]
+            self.node_files[key] = self.open(path, header)
+            self.node_file_names.append(path)
+
+        row = [identity] + [csv_value(properties[x]) for x in columns]
+        self.node_files[key].writerow(row + [resource.kind])
+
+        self.nodes.add(identity, properties)
+
+    def write_relationship(self, start: str, end: str, relationship: str) -> None:
+        edge = (start, end, relationship)
+        if edge in self.edges:
+            return
+        self.edges.add(edge)
+
+        if relationship not in self.relationship_files:
+            self.relationship_files[relationship] = self.open(
+                self.path / "relationships" / f"{relationship}.csv",
+                [":START_ID", ":END_ID", ":TYPE"],
+            )
+        self.relationship_files[relationship].writerow([start, end, relationship])
+
+    def endpoint(self, resource: Union[Resource, ResourceRef]) -> str:
+        identity = resource.identity
+        if identity not in self.nodes:
+            self.stubs.setdefault(identity, resource)
+        return identity
+
+    def add_relationships(
+        self, resource: Union[Resource, ResourceRef], initial: bool
+    ) -> None:
+        for source, relationship, target in resource.relationships(initial):
+            types = [relationship] if isinstance(relationship, str) else relationship
+
+            if isinstance(source, (Resource, ResourceRef)) and isinstance(
+                target, (Resource, ResourceRef)
+            ):
+                start, end = self.endpoint(source), self.endpoint(target)
+                for x in types:
+                    self.write_relationship(start, end, x)
+            elif isinstance(source, (Resource, ResourceRef)) and not isinstance(
+                target, (Resource, ResourceRef)
+            ):
+                self.query_edges.append((self.endpoint(source), target, types, True))
+            elif isinstance(target, (Resource, ResourceRef)) and not isinstance(
+                source, (Resource, ResourceRef)
+            ):
+                self.query_edges.append((self.endpoint(target), source, types, False))
+            else:
+                logger.warning(f"Skipping relationship between two queries: {types}")
+
+    def add(self, resource: Resource) -> None:
+        self.write_node(resource, store_raw(resource.db_labels))
+        self.stubs.pop(resource.identity, None)
+
+        if isinstance(resource, (ClusterRole, Role)):
+            self.roles[(resource.kind, resource.namespace, resource.name)] = resource
+
+        if isinstance(resource, (ClusterRoleBinding, RoleBinding)):
+            # Bindings need their roles, which may not have been seen yet
+            self.bindings.append(resource)
+        else:
+            self.add_relationships(resource, initial=True)
+
+    def resolve_role(self, binding: Union[ClusterRoleBinding, RoleBinding]) -> None:
+        ref = binding.role_ref
+        if not ref.name:
+            # No roleRef
+            return
+        role = self.roles.get((ref.kind, ref.namespace, ref.name))
+        # Set the role, rather than looking the role up in neo4j
+        binding.role = role if role is not None else mock_role(ref)
+
+    def close(self) -> None:
+        for binding in self.bindings:
+            self.resolve_role(binding)
+            self.add_relationships(binding, initial=False)
+
+        # Nodes only created through relationships, which neo4j would create
+        # with only their unique identifiers before generating their own
+        # relationships in the second pass
+        stubs = list(self.stubs.values())
+        for stub in stubs:
+            self.write_node(stub, stub.unique_identifiers)
+        for stub in stubs:
+            self.add_relationships(stub, initial=False)
+        for stub in self.stubs.values():
+            self.write_node(stub, stub.unique_identifiers)
+
+        for identity, query, types, outgoing in self.query_edges:
+            try:
+                resolved = self.nodes.resolve(query)
+            except ValueError as e:
+                logger.warning(f"Skipping relationships {types}: {e}")
+                continue
+
+            for other in resolved:
+                for x in types:
+                    if outgoing:
+                        self.write_relationship(identity, other, x)
+                    else:
+                        self.write_relationship(other, identity, x)
+
+        self.close_files()
+
+        with open(self.path / "import.sh", "w") as fs:
+            fs.write(self.import_command() + "\n")
+
+        logger.info(
+            f"Exported {len(self.nodes)} nodes and {len(self.edges)} relationships",
+        )
+
+    def close_files(self) -> None:
+        for fs in self.files:
+            fs.close()
+        self.files = []
+
+    def import_command(self, database: str = "neo4j") -> str:
+        cmd = [
+            "neo4j-admin",
+            "database",
+            "import",
+            "full",
+            "--overwrite-destination",
+            "--multiline-fields=true",
+            f"--array-delimiter={ARRAY_DELIMITER}",
+        ]
+        cmd += [f"--nodes={x.resolve()}" for x in self.node_file_names]
+        cmd += [
+            f"--relationships={(self.path / 'relationships' / f'{x}.csv').resolve()}"
+            for x in self.relationship_files
+        ]
+        cmd += [database]
+        return " ".join(shlex.quote(x) for x in cmd)
+
+
+def export_admin_import(resources: Iterable[Resource], output_dir: str) -> str:
+    """Write import CSV files for the resources, returning the import command."""
+    with AdminImportWriter(output_dir) as writer:
+        for resource in resources:
+            writer.add(resource)
+
+    return writer.import_command()
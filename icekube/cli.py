@@ -1,41 +1,85 @@
+import itertools
 import json
 import logging
 from pathlib import Path
-from typing import Iterator, List, Optional, cast
+from typing import Iterator, List, Optional, Set, Tuple
 
 import typer
+from icekube.bulk_import import AdminImportWriter, export_admin_import
 from icekube.config import config
+from icekube.delta import (
+    Delta,
+    apply_snapshot_delta,
+    diff_snapshots,
+    has_content_hashes,
+    update_from_cluster,
+)
 from icekube.icekube import (
+    base_resources,
+    create_attack_path_indices,
     create_indices,
     enumerate_resource_kind,
+    find_starting_points,
     generate_relationships,
+    mark_attack_paths,
     purge_neo4j,
+    reachable_paths,
     remove_attack_paths,
+    remove_reachability,
     setup_attack_paths,
+    setup_attack_paths_from,
+    setup_reachability,
 )
-from icekube.kube import (
-    APIResource,
-    Resource,
-    all_resources,
-    metadata_download,
-)
+from icekube.kube import Resource, all_resources, metadata_download
 from icekube.log_config import build_logger
-from tqdm import tqdm
+from icekube.models.pod import pod_feature_cache
+from icekube.neo4j import missing_raw_store
+from icekube.profiling import profiler
+from icekube.reachability import reachability_targets
+from icekube.snapshot import (
+    COMPRESSION_SUFFIXES,
+    FORMATS,
+    load_snapshot,
+    open_snapshot_writer,
+    use_snapshot_metadata,
+)
+from icekube.trimming import load_profiles, trim_report
 
 app = typer.Typer()
 
 IGNORE_DEFAULT = "events,componentstatuses"
 
 
+def require_raw_store() -> None:
+    """Fail before reading resources back from neo4j if their payloads cannot be."""
+    if missing_raw_store():
+        raise typer.BadParameter(
+            "neo4j holds resources saved with --raw-store, which is needed to "
+            "read them",
+            param_hint="--raw-store",
+        )
+
+
 @app.command()
 def run(
     ignore: str = typer.Option(
         IGNORE_DEFAULT,
         help="Names of resource types to ignore",
     ),
+    full: bool = typer.Option(
+        False,
+        help="Rewrite every resource, rather than only those changed since the "
+        "last run",
+    ),
 ):
-    enumerate(ignore)
-    attack_path()
+    if not full and has_content_hashes():
+        require_raw_store()
+        create_indices()
+        print_delta(update_from_cluster(ignore.split(","), attack_paths=True))
+        return
+
+    enumerate(ignore, full=True)
+    attack_path(from_namespace=[], from_group=[], from_user=[])
 
 
 @app.command()
@@ -44,21 +88,117 @@ def enumerate(
         IGNORE_DEFAULT,
         help="Names of resource types to ignore",
     ),
+    full: bool = typer.Option(
+        False,
+        help="Rewrite every resource, rather than only those changed since the "
+        "last run",
+    ),
 ):
     create_indices()
+    if not full and has_content_hashes():
+        require_raw_store()
+        print_delta(update_from_cluster(ignore.split(","), attack_paths=False))
+        return
+
     enumerate_resource_kind(ignore.split(","))
+    # Checked once resources are rewritten, as their raw payloads are then held
+    require_raw_store()
     generate_relationships()
+    mark_attack_paths(False)
 
 
 @app.command()
 def relationships():
+    require_raw_store()
     generate_relationships()
 
 
 @app.command()
-def attack_path():
+def attack_path(
+    from_namespace: List[str] = typer.Option(
+        [],
+        help="Only generate attack paths reachable from ServiceAccounts and Pods "
+        "within this namespace",
+    ),
+    from_group: List[str] = typer.Option(
+        [],
+        help="Only generate attack paths reachable from this group",
+    ),
+    from_user: List[str] = typer.Option(
+        [],
+        help="Only generate attack paths reachable from this user",
+    ),
+):
+    mark_attack_paths(False)
     remove_attack_paths()
-    setup_attack_paths()
+    remove_reachability()
+    create_attack_path_indices()
+
+    if from_namespace or from_group or from_user:
+        start = find_starting_points(from_namespace, from_group, from_user)
+        setup_attack_paths_from(start)
+    else:
+        setup_attack_paths()
+
+    setup_reachability()
+    mark_attack_paths(True)
+
+
+@app.command()
+def paths(
+    source: Optional[str] = typer.Option(
+        None,
+        "--from",
+        help="Starting resource as Kind/name or Kind/namespace/name, "
+        "all principals if not provided",
+    ),
+    target: Optional[str] = typer.Option(
+        None,
+        "--to",
+        help=f"Crown-jewel target, one of: {', '.join(reachability_targets)}",
+    ),
+):
+    targets = [target] if target else list(reachability_targets)
+    for t in targets:
+        if t not in reachability_targets:
+            raise typer.BadParameter(f"Unknown target: {t}", param_hint="--to")
+
+    filters = {}
+    if source:
+        parts = source.split("/", 2)
+        if len(parts) < 2:
+            raise typer.BadParameter(
+                "Expected Kind/name or Kind/namespace/name",
+                param_hint="--from",
+            )
+        filters["kind"] = parts[0]
+        filters["name"] = parts[-1]
+        if len(parts) == 3:
+            filters["namespace"] = parts[1]
+
+    for t in targets:
+        for path in reachable_paths(t, **filters):
+            if source:
+                print(f"{t} ({len(path) - 1} hops):")
+                for resource, relationship in path:
+                    print(f"  {resource}")
+                    if relationship:
+                        print(f"    -[{relationship}]->")
+            else:
+                print(f"{t}: {len(path) - 1} hops from {path[0][0]}")
+
+
+@app.command()
+def analytics(
+    top: int = typer.Option(10, help="Number of results to show for each ranking"),
+):
+    try:
+        from icekube.analytics import attack_graph_analytics
+    except ImportError:
+        print("numpy is required for analytics, install it with: pip install numpy")
+        raise typer.Exit(1)
+
+    attack_graph_analytics(top)
 
 
 @app.command()
@@ -66,106 +206,284 @@ def purge():
     purge_neo4j()
 
 
+def print_admin_import(command: str) -> None:
+    print("Import the CSV files into a stopped neo4j instance with:")
+    print(command)
+    print("Then start neo4j and run `icekube attack-path`")
+
+
 @app.command()
-def download(output_dir: str):
+def download(
+    output_dir: str,
+    admin_import: Optional[str] = typer.Option(
+        None,
+        help="Also write neo4j-admin import CSV files to this directory",
+    ),
+    output_format: str = typer.Option(
+        "json",
+        "--format",
+        help=f"Format of the saved files, one of: {', '.join(FORMATS)}",
+    ),
+    compress: Optional[str] = typer.Option(
+        None,
+        help=f"Compress the saved files, one of: {', '.join(COMPRESSION_SUFFIXES)}",
+    ),
+):
+    if output_format not in FORMATS:
+        raise typer.BadParameter(
+            f"Unknown format: {output_format}",
+            param_hint="--format",
+        )
+    if compress is not None and compress not in COMPRESSION_SUFFIXES:
+        raise typer.BadParameter(
+            f"Unknown compression: {compress}",
+            param_hint="--compress",
+        )
+    if compress is not None and output_format == "pack":
+        raise typer.BadParameter(
+            "Pack files cannot be compressed",
+            param_hint="--compress",
+        )
+    if compress == "zstd":
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            print(
+                "zstandard is required for zstd, install it with: pip install zstandard"
+            )
+            raise typer.Exit(1)
+
     path = Path(output_dir)
     path.mkdir(exist_ok=True)
 
     resources = all_resources()
     metadata = metadata_download()
 
+    writer = AdminImportWriter(admin_import) if admin_import else None
+    if writer:
+        for resource in base_resources():
+            writer.add(resource)
+
     with open(path / "_metadata.json", "w") as fs:
         fs.write(json.dumps(metadata, indent=2, default=str))
 
-    current_type = None
-    current_group = []
-
-    for resource in resources:
-        if current_type is None:
-            current_type = resource.resource_definition_name
-        elif current_type != resource.resource_definition_name:
-            with open(path / f"{current_type}.json", "w") as fs:
-                fs.write(json.dumps(current_group, indent=4, default=str))
-            current_group = []
-            current_type = resource.resource_definition_name
+    with open_snapshot_writer(path, output_format, compress) as snapshot:
+        for resource in resources:
+            snapshot.write(resource)
 
-        if resource.raw:
-            current_group.append(json.loads(resource.raw))
+            if writer:
+                writer.add(resource)
 
-    if current_type:
-        with open(path / f"{current_type}.json", "w") as fs:
-            fs.write(json.dumps(current_group, indent=4, default=str))
+    if writer:
+        print("Resolving relationships")
+        writer.close()
+        print_admin_import(writer.import_command())
 
 
 @app.command()
-def load(input_dir: str, attack_paths: bool = True):
+def load(
+    input_dir: str,
+    attack_paths: bool = True,
+    admin_import: Optional[str] = typer.Option(
+        None,
+        help="Write neo4j-admin import CSV files to this directory, "
+        "instead of loading into a running neo4j",
+    ),
+    processes: Optional[int] = typer.Option(
+        None,
+        help="Number of processes parsing files, defaults to the number of CPUs",
+    ),
+    kind: List[str] = typer.Option(
+        [],
+        help="Only load resources of this kind",
+    ),
+    namespace: List[str] = typer.Option(
+        [],
+        help="Only load resources within this namespace",
+    ),
+    full: bool = typer.Option(
+        False,
+        help="Rewrite every resource, rather than only those changed since the "
+        "last run",
+    ),
+):
     path = Path(input_dir)
     metadata = json.load(open(path / "_metadata.json"))
 
     from icekube import kube
     from icekube import icekube
 
-    kube.kube_version = lambda: cast(str, metadata["kube_version"])
-    kube.context_name = lambda: cast(str, metadata["context_name"])
-    kube.api_versions = lambda: cast(List[str], metadata["api_versions"])
-    kube.preferred_versions = metadata["preferred_versions"]
-    kube.api_resources = lambda: cast(
-        List[APIResource],
-        [APIResource(**x) for x in metadata["api_resources"]],
-    )
-
-    icekube.api_resources = kube.api_resources
-    icekube.context_name = kube.context_name
-    icekube.kube_version = kube.kube_version
+    use_snapshot_metadata(metadata)
 
     def all_resources(
         preferred_versions_only: bool = True,
         ignore: Optional[List[str]] = None,
+        listed: Optional[Set[Tuple[str, Optional[str]]]] = None,
     ) -> Iterator[Resource]:
+        # Everything is taken as listed, as the download holds what it could
+        if listed is not None:
+            listed.update((x.kind, None) for x in kube.api_resources())
         print("Loading files from disk")
-
-        for file in tqdm(path.glob("*")):
-            if file.name == "_metadata.json":
-                continue
-            try:
-                # If downloaded via kubectl get -A
-                data = json.load(open(file))["items"]
-            except TypeError:
-                # If downloaded via icekube download
-                data = json.load(open(file))
-
-            for resource in data:
-                yield Resource(
-                    apiVersion=resource["apiVersion"],
-                    kind=resource["kind"],
-                    name=resource["metadata"]["name"],
-                    namespace=resource["metadata"].get("namespace"),
-                    plural=file.name.split(".")[0],
-                    raw=json.dumps(resource, default=str),
-                )
+        yield from load_snapshot(path, metadata, processes, kind, namespace)
         print("")
 
     kube.all_resources = all_resources
     icekube.all_resources = all_resources
 
+    if admin_import:
+        resources = itertools.chain(base_resources(), all_resources())
+        print_admin_import(export_admin_import(resources, admin_import))
+        return
+
+    # Anything not loaded would otherwise be seen as removed
+    full = full or bool(kind or namespace)
     if attack_paths:
-        run(IGNORE_DEFAULT)
+        run(IGNORE_DEFAULT, full)
     else:
-        enumerate(IGNORE_DEFAULT)
+        enumerate(IGNORE_DEFAULT, full)
+
+
+def print_delta(delta: Delta) -> None:
+    print(
+        f"{len(delta.added)} added, {len(delta.changed)} changed, "
+        f"{len(delta.removed)} removed",
+    )
+    for kind, counts in sorted(delta.summary().items()):
+        print(
+            f"  {kind}: {counts['added']} added, {counts['changed']} changed, "
+            f"{counts['removed']} removed",
+        )
+
+
+@app.command()
+def diff(
+    old_dir: str,
+    new_dir: str,
+    output: str = typer.Option(
+        "delta.json",
+        help="File to save the differences to, for use with apply-delta",
+    ),
+    processes: Optional[int] = typer.Option(
+        None,
+        help="Number of processes parsing files, defaults to the number of CPUs",
+    ),
+):
+    delta = diff_snapshots(Path(old_dir), Path(new_dir), processes)
+
+    with open(output, "w") as fs:
+        fs.write(delta.model_dump_json(indent=2))
+
+    print_delta(delta)
+
+
+@app.command()
+def apply_delta(
+    delta_file: str,
+    attack_paths: bool = True,
+    processes: Optional[int] = typer.Option(
+        None,
+        help="Number of processes parsing files, defaults to the number of CPUs",
+    ),
+):
+    delta = Delta.model_validate_json(open(delta_file).read())
+    require_raw_store()
+    apply_snapshot_delta(delta, attack_paths, processes)
 
 
 @app.callback()
 def callback(
+    ctx: typer.Context,
     neo4j_url: str = typer.Option("bolt://localhost:7687", show_default=True),
     neo4j_user: str = typer.Option("neo4j", show_default=True),
     neo4j_password: str = typer.Option("neo4j", show_default=True),
     neo4j_encrypted: bool = typer.Option(False, show_default=True),
+    neo4j_pool_size: int = typer.Option(
+        100,
+        show_default=True,
+        help="Maximum number of connections to neo4j",
+    ),
+    writers: int = typer.Option(
+        8,
+        show_default=True,
+        help="Number of concurrent sessions writing to neo4j",
+    ),
+    write_batch_size: int = typer.Option(
+        100,
+        show_default=True,
+        help="Number of queries written to neo4j in each transaction",
+    ),
+    retry_time: float = typer.Option(
+        30.0,
+        show_default=True,
+        help="Seconds to keep retrying a transaction after transient errors",
+    ),
+    retry_delay: float = typer.Option(
+        1.0,
+        show_default=True,
+        help="Seconds to wait before the first retry, doubling after each attempt",
+    ),
+    raw_store: Optional[str] = typer.Option(
+        None,
+        help="Keep the raw JSON of resources compressed within this directory, "
+        "saving only a reference to it in neo4j",
+    ),
+    dangerous_host_path: List[str] = typer.Option(
+        [],
+        help="Treat pods mounting this path, or a parent of it, from the node as "
+        "dangerous, in addition to the built in paths",
+    ),
+    secret_type: List[str] = typer.Option(
+        [],
+        help="Keep the type of secrets of this type, in addition to service "
+        "account tokens, at the cost of listing secrets again for each type",
+    ),
+    trim: bool = typer.Option(
+        True,
+        help="Remove fields IceKube does not use, such as status and "
+        "managedFields, from resources as they are listed",
+    ),
+    trim_profiles: Optional[str] = typer.Option(
+        None,
+        help="JSON file mapping kinds, or * for every kind, to further paths to "
+        "trim, each a list of keys",
+    ),
     verbose: int = typer.Option(0, "--verbose", "-v", count=True),
+    profile_report: Optional[str] = typer.Option(
+        None,
+        help="Record statistics for each query and save them to this JSON file",
+    ),
+    profile_plan: bool = typer.Option(
+        False,
+        help="Run queries with PROFILE to capture db hits and plans, "
+        "requires --profile-report",
+    ),
+    slow_query_threshold: float = typer.Option(
+        5.0,
+        help="Log queries taking longer than this many seconds when profiling",
+    ),
 ):
     config["neo4j"]["url"] = neo4j_url
     config["neo4j"]["username"] = neo4j_user
     config["neo4j"]["password"] = neo4j_password
     config["neo4j"]["encrypted"] = neo4j_encrypted
+    config["neo4j"]["pool_size"] = neo4j_pool_size
+    config["neo4j"]["writers"] = writers
+    config["neo4j"]["batch_size"] = write_batch_size
+    config["neo4j"]["retry_time"] = retry_time
+    config["neo4j"]["retry_delay"] = retry_delay
+    config["raw_store"] = raw_store
+    config["dangerous_host_paths"] = dangerous_host_path
+    config["secret_types"] = secret_type
+    config["trim"] = trim
+    config["trim_profiles"] = load_profiles(trim_profiles) if trim_profiles else {}
+
+    config["profile"]["enabled"] = profile_report is not None
+    config["profile"]["plan"] = profile_plan
+    config["profile"]["slow_query_threshold"] = slow_query_threshold
+    if profile_report:
+        ctx.call_on_close(lambda: profiler.save(profile_report))
+    ctx.call_on_close(pod_feature_cache.report)
+    ctx.call_on_close(trim_report.report)
 
     verbosity_levels = {
         0: logging.ERROR,
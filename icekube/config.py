@@ -1,4 +1,4 @@
-from typing import TypedDict
+from typing import Dict, List, Optional, TypedDict
 
 
 class Neo4j(TypedDict):
@@ -6,10 +6,27 @@ class Neo4j(TypedDict):
     username: str
     password: str
     encrypted: bool
+    pool_size: int
+    writers: int
+    batch_size: int
+    retry_time: float
+    retry_delay: float
+
+
+class Profile(TypedDict):
+    enabled: bool
+    plan: bool
+    slow_query_threshold: float
 
 
 class Config(TypedDict):
     neo4j: Neo4j
+    profile: Profile
+    raw_store: Optional[str]
+    dangerous_host_paths: List[str]
+    secret_types: List[str]
+    trim: bool
+    trim_profiles: Dict[str, List[List[str]]]
 
 
 config: Config = {
@@ -18,5 +35,20 @@ config: Config = {
         "username": "neo4j",
         "password": "neo4j",
         "encrypted": False,
+        "pool_size": 100,
+        "writers": 8,
+        "batch_size": 100,
+        "retry_time": 30.0,
+        "retry_delay": 1.0,
+    },
+    "profile": {
+        "enabled": False,
+        "plan": False,
+        "slow_query_threshold": 5.0,
     },
+    "raw_store": None,
+    "dangerous_host_paths": [],
+    "secret_types": [],
+    "trim": True,
+    "trim_profiles": {},
 }
@@ -0,0 +1,564 @@
+"""Comparing two downloads, and applying the differences to an existing graph.
+
+Resources are matched between downloads by identity. A resource is unchanged if
+its resourceVersion is the same, or otherwise if its content hash is the same.
+The resources within a cluster can also be compared against those already held
+in neo4j, which stores the content hash of each resource.
+
+Applying a delta only rewrites the nodes that were added, changed or removed.
+Relationships are regenerated in full for those nodes, and for every other
+resource that could have a relationship with them, only the relationships to
+them are regenerated, evaluating query endpoints in memory. Attack paths are
+then regenerated for sources or destinations next to a node that changed.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from icekube import kube
+from icekube.icekube import (
+    EdgeDeduplicator,
+    attack_paths_current,
+    base_resources,
+    create_attack_path_indices,
+    mark_attack_paths,
+    ordered_attack_path_queries,
+    relationship_generator,
+    remove_attack_paths,
+    remove_reachability,
+    setup_attack_paths,
+    setup_reachability,
+)
+from icekube.models import Cluster, Resource
+from icekube.models.base import ResourceRef
+from icekube.models.clusterrole import ClusterRole
+from icekube.models.clusterrolebinding import ClusterRoleBinding
+from icekube.models.role import Role
+from icekube.models.rolebinding import RoleBinding
+from icekube.neo4j import (
+    Writer,
+    create,
+    find,
+    get_driver,
+    resolve_roles,
+    write,
+)
+from icekube.query_matcher import NodeIndex
+from icekube.snapshot import (
+    PACK_NAME,
+    PackedSnapshot,
+    load_snapshot,
+    use_snapshot_metadata,
+)
+from pydantic import BaseModel
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# resourceVersion, content hash and details of a resource within a download
+SnapshotVersion = Tuple[Optional[str], str, Tuple[str, str, str, str, Optional[str]]]
+
+
+class DeltaResource(BaseModel):
+    identity: str
+    apiVersion: str
+    kind: str
+    name: str
+    plural: str
+    namespace: Optional[str] = None
+
+    @classmethod
+    def from_resource(cls, resource: Resource) -> DeltaResource:
+        return cls(
+            identity=resource.identity,
+            apiVersion=resource.apiVersion,
+            kind=resource.kind,
+            name=resource.name,
+            plural=resource.plural,
+            namespace=resource.namespace,
+        )
+
+
+class Delta(BaseModel):
+    old: str
+    new: str
+    kube_version_changed: bool = False
+    added: List[DeltaResource] = []
+    changed: List[DeltaResource] = []
+    removed: List[DeltaResource] = []
+
+    def summary(self) -> Dict[str, Dict[str, int]]:
+        """Number of added, changed and removed resources of each kind."""
+        counts: Dict[str, Dict[str, int]] = {}
+        for change in ["added", "changed", "removed"]:
+            for x in getattr(self, change):
+                kind = counts.setdefault(
+                    x.kind, dict.fromkeys(["added", "changed", "removed"], 0)
+                )
+                kind[change] += 1
+        return counts
+
+
+def snapshot_versions(
+    path: Path,
+    processes: Optional[int] = None,
+) -> Tuple[Dict[str, Any], Dict[str, SnapshotVersion]]:
+    metadata = json.load(open(path / "_metadata.json"))
+    use_snapshot_metadata(metadata)
+
+    versions: Dict[str, SnapshotVersion] = {}
+    for resource in load_snapshot(path, metadata, processes):
+        versions[resource.identity] = (
+            resource.resource_version,
+            resource.content_hash,
+            (
+                resource.apiVersion,
+                resource.kind,
+                resource.name,
+                resource.plural,
+                resource.namespace,
+            ),
+        )
+    return metadata, versions
+
+
+def delta_resource(identity: str, version: SnapshotVersion) -> DeltaResource:
+    apiVersion, kind, name, plural, namespace = version[2]
+    return DeltaResource(
+        identity=identity,
+        apiVersion=apiVersion,
+        kind=kind,
+        name=name,
+        plural=plural,
+        namespace=namespace,
+    )
+
+
+def diff_snapshots(old: Path, new: Path, processes: Optional[int] = None) -> Delta:
+    print("Reading old snapshot")
+    old_metadata, before = snapshot_versions(old, processes)
+    print("Reading new snapshot")
+    new_metadata, after = snapshot_versions(new, processes)
+
+    delta = Delta(
+        old=str(old.resolve()),
+        new=str(new.resolve()),
+        kube_version_changed=old_metadata["kube_version"]
+        != new_metadata["kube_version"],
+    )
+
+    for identity, version in after.items():
+        if identity not in before:
+            delta.added.append(delta_resource(identity, version))
+            continue
+
+        resource_version, content_hash, _ = version
+        old_resource_version, old_content_hash, _ = before[identity]
+        if resource_version is not None and resource_version == old_resource_version:
+            continue
+        if content_hash != old_content_hash:
+            delta.changed.append(delta_resource(identity, version))
+
+    for identity, version in before.items():
+        if identity not in after:
+            delta.removed.append(delta_resource(identity, version))
+
+    return delta
+
+
+def by_kind(resources: Iterable[DeltaResource]) -> Dict[str, List[str]]:
+    kinds: Dict[str, List[str]] = {}
+    for x in resources:
+        kinds.setdefault(x.kind, []).append(x.identity)
+    return kinds
+
+
+def query_nodes(cmd: str, resources: Iterable[DeltaResource]) -> Dict[str, Resource]:
+    """Run a query for each kind of resource, returning the nodes found.
+
+    `cmd` is formatted with the kind, and given the identities as `$ids`.
+    """
+    found: Dict[str, Resource] = {}
+    with get_driver().session() as session:
+        for kind, identities in by_kind(resources).items():
+            for (node,) in session.run(cmd.format(kind=kind), ids=identities):
+                props = node._properties
+                found[props["identity"]] = Resource(**props)
+    return found
+
+
+def bindings_granting(resources: Iterable[DeltaResource]) -> Dict[str, Resource]:
+    roles = [x for x in resources if x.kind in [ClusterRole.__name__, Role.__name__]]
+    return query_nodes(
+        "MATCH (b)-[:GRANTS_PERMISSION]->(n:{kind}) WHERE n.identity IN $ids "
+        "RETURN DISTINCT b",
+        roles,
+    )
+
+
+def find_neighbours(resources: Iterable[DeltaResource]) -> Dict[str, Resource]:
+    return query_nodes(
+        "MATCH (n:{kind})-[r]-(m) WHERE n.identity IN $ids "
+        "AND r.attack_path IS NULL RETURN DISTINCT m",
+        resources,
+    )
+
+
+def relationship_sources(
+    neighbours: Iterable[Resource],
+    resources: Iterable[DeltaResource],
+) -> Dict[str, Resource]:
+    """Resources that could have relationships with the given resources.
+
+    Query endpoints are generated by the cluster and bindings, so as well as
+    existing neighbours, this includes the cluster, every ClusterRoleBinding,
+    and RoleBindings within the namespaces of the resources.
+    """
+    sources = {x.identity: x for x in neighbours}
+
+    namespaces: Set[str] = set()
+    for x in resources:
+        if x.namespace:
+            namespaces.add(x.namespace)
+        elif x.kind == "Namespace":
+            namespaces.add(x.name)
+
+    found = [find(Cluster), find(ClusterRoleBinding)]
+    found += [find(RoleBinding, namespace=x) for x in sorted(namespaces)]
+    for results in found:
+        for resource in results:
+            sources.setdefault(resource.identity, resource)
+
+    return sources
+
+
+def scoped_relationship_generator(
+    writer: Writer,
+    resource: Resource,
+    index: NodeIndex,
+    resources: Dict[str, Resource],
+    scope: Set[str],
+    edges: EdgeDeduplicator,
+) -> None:
+    """Create the relationships of a resource that involve resources in scope.
+
+    Query endpoints are only matched against the resources held in `index`.
+    """
+    for source, relationship, target in resource.relationships(initial=False):
+        if isinstance(source, (Resource, ResourceRef)) and isinstance(
+            target, (Resource, ResourceRef)
+        ):
+            if source.identity in scope or target.identity in scope:
+                edges.run(writer, source, relationship, target)
+            continue
+
+        try:
+            if isinstance(source, (Resource, ResourceRef)):
+                for x in index.resolve(target):  # type: ignore
+                    edges.run(writer, source, relationship, resources[x])
+            elif isinstance(target, (Resource, ResourceRef)):
+                for x in index.resolve(source):
+                    edges.run(writer, resources[x], relationship, target)
+        except ValueError as e:
+            logger.info(f"Evaluating relationship {relationship} in neo4j: {e}")
+            edges.run(writer, source, relationship, target)
+
+
+def node_ids(resources: Iterable[DeltaResource], neighbours: bool) -> Set[int]:
+    """neo4j ids of the nodes for resources, optionally with their neighbours."""
+    ids: Set[int] = set()
+    with get_driver().session() as session:
+        for kind, identities in by_kind(resources).items():
+            cmd = f"MATCH (n:{kind}) WHERE n.identity IN $ids "
+            if neighbours:
+                cmd += "OPTIONAL MATCH (n)-[r]-(m) WHERE r.attack_path IS NULL "
+                cmd += "RETURN id(n), collect(DISTINCT id(m))"
+            else:
+                cmd += "RETURN id(n), []"
+            for node, others in session.run(cmd, ids=identities):
+                ids.add(node)
+                ids.update(others)
+    return ids
+
+
+def update_attack_paths(affected: List[int]) -> None:
+    """Regenerate attack paths with their source or destination within `affected`.
+
+    Every node an attack path query passes through is next to its source or
+    destination, so this covers all attack paths affected by changes to the
+    neighbours of `affected`.
+    """
+    write(
+        "MATCH (n)-[r]-() WHERE id(n) IN $ids AND r.attack_path IS NOT NULL "
+        "WITH DISTINCT r DELETE r",
+        {"ids": affected},
+    )
+
+    # Created here too, as the graph may have been loaded without them
+    create_attack_path_indices()
+    parameters = {"affected": affected}
+    for group in ordered_attack_path_queries():
+        with Writer(batch_size=1) as writer:
+            for name, query in group:
+                match, merge = query.rsplit(" MERGE ", 1)
+                writer.run(
+                    "MATCH (src) WHERE id(src) IN $affected WITH src " + query,
+                    parameters,
+                    name,
+                )
+                # Skip sources already covered above
+                writer.run(
+                    "MATCH (dest) WHERE id(dest) IN $affected WITH dest "
+                    + match
+                    + " WITH src, dest WHERE NOT id(src) IN $affected MERGE "
+                    + merge,
+                    parameters,
+                    name,
+                )
+
+    remove_reachability()
+    setup_reachability()
+
+
+def stored_resources(kind: str) -> Dict[str, Tuple[str, DeltaResource]]:
+    """Content hashes of the resources of a kind held in neo4j, by identity."""
+    cmd = (
+        f"MATCH (n:{kind}) WHERE n.content_hash IS NOT NULL "
+        "RETURN n.content_hash, n.identity, n.apiVersion, n.name, n.plural, "
+        "n.namespace"
+    )
+    with get_driver().session() as session:
+        return {
+            identity: (
+                content_hash,
+                DeltaResource(
+                    identity=identity,
+                    apiVersion=api_version,
+                    kind=kind,
+                    name=name,
+                    plural=plural,
+                    namespace=namespace,
+                ),
+            )
+            for content_hash, identity, api_version, name, plural, namespace in (
+                session.run(cmd)
+            )
+        }
+
+
+def has_content_hashes() -> bool:
+    """Whether neo4j holds resources that can be compared by content hash."""
+    cmd = "MATCH (n) WHERE n.content_hash IS NOT NULL RETURN 1 LIMIT 1"
+    with get_driver().session() as session:
+        return session.run(cmd).single() is not None
+
+
+def stored_kube_version() -> Optional[str]:
+    cmd = "MATCH (n:Cluster { name: $name }) RETURN n.version"
+    with get_driver().session() as session:
+        result = session.run(cmd, name=kube.context_name()).single()
+    return result[0] if result else None
+
+
+def cluster_delta(ignore: Optional[List[str]] = None) -> Tuple[Delta, List[Resource]]:
+    """Compare the resources within the cluster against those held in neo4j.
+
+    The stored content hashes are read once for each kind listed. Only the
+    resources that were added or changed are returned. Stored resources are
+    only seen as removed if their kind and namespace were listed successfully.
+    """
+    if ignore is None:
+        ignore = []
+
+    delta = Delta(
+        old="neo4j",
+        new=kube.context_name(),
+        kube_version_changed=stored_kube_version() != kube.kube_version(),
+    )
+
+    stored = {
+        x.kind: stored_resources(x.kind)
+        for x in kube.api_resources()
+        if "list" in x.verbs and x.preferred and x.name not in ignore
+    }
+
+    resources: List[Resource] = []
+    seen: Set[str] = set()
+    listed: Set[Tuple[str, Optional[str]]] = set()
+    for resource in kube.all_resources(ignore=ignore, listed=listed):
+        if resource.kind not in stored:
+            stored[resource.kind] = stored_resources(resource.kind)
+
+        identity = resource.identity
+        seen.add(identity)
+        previous = stored[resource.kind].get(identity)
+        if previous and previous[0] == resource.content_hash:
+            continue
+
+        resources.append(resource)
+        entry = DeltaResource.from_resource(resource)
+        if previous:
+            delta.changed.append(entry)
+        else:
+            delta.added.append(entry)
+
+    for kind, hashes in stored.items():
+        for identity, (_, entry) in hashes.items():
+            if identity in seen:
+                continue
+            if (kind, None) in listed or (kind, entry.namespace) in listed:
+                delta.removed.append(entry)
+
+    return delta, resources
+
+
+def update_from_cluster(
+    ignore: Optional[List[str]] = None,
+    attack_paths: bool = True,
+) -> Delta:
+    """Update neo4j with only the resources that changed within the cluster."""
+    delta, resources = cluster_delta(ignore)
+    apply_changes(delta, resources, attack_paths)
+    return delta
+
+
+def apply_snapshot_delta(
+    delta: Delta,
+    attack_paths: bool = True,
+    processes: Optional[int] = None,
+) -> None:
+    path = Path(delta.new)
+    metadata = json.load(open(path / "_metadata.json"))
+    use_snapshot_metadata(metadata)
+
+    present = delta.added + delta.changed
+    wanted = {x.identity for x in present}
+    resources: List[Resource] = []
+    if wanted and (path / PACK_NAME).exists():
+        print("Loading changed resources")
+        # Only the changed records are read, through the index of the pack
+        with PackedSnapshot(path / PACK_NAME) as pack:
+            for x in present:
+                resource = pack.get(x.apiVersion, x.kind, x.name, x.namespace)
+                if resource is not None:
+                    resources.append(resource)
+    elif wanted:
+        print("Loading changed resources")
+        kinds = sorted({x.kind for x in present})
+        resources = [
+            x
+            for x in load_snapshot(path, metadata, processes, kinds)
+            if x.identity in wanted
+        ]
+
+    apply_changes(delta, resources, attack_paths)
+
+
+def regenerate_attack_paths() -> None:
+    remove_attack_paths()
+    remove_reachability()
+    create_attack_path_indices()
+    setup_attack_paths()
+    setup_reachability()
+    mark_attack_paths(True)
+
+
+def apply_changes(
+    delta: Delta,
+    resources: List[Resource],
+    attack_paths: bool = True,
+) -> None:
+    """Apply a delta to neo4j, given the resources that were added or changed."""
+    # Attack paths depend on the cluster version, so all need regenerating, as
+    # do any missing before these changes, such as after `icekube enumerate`
+    regenerate = attack_paths and (
+        delta.kube_version_changed or not attack_paths_current()
+    )
+
+    present = delta.added + delta.changed
+    if not present and not delta.removed and not delta.kube_version_changed:
+        print("No resources changed")
+        if regenerate:
+            regenerate_attack_paths()
+        return
+
+    # Bindings to a role that changed need their permissions regenerated, so
+    # are treated as changed too
+    touched = present + delta.removed
+    skip = {x.identity for x in touched}
+    rebound = [x for x in bindings_granting(touched).values() if x.identity not in skip]
+    resources += rebound
+    rebound_entries = [DeltaResource.from_resource(x) for x in rebound]
+    entries = [DeltaResource.from_resource(x) for x in resources]
+
+    print("Finding affected resources")
+    neighbours = find_neighbours(touched + rebound_entries)
+    old_neighbours = [
+        DeltaResource.from_resource(x)
+        for identity, x in neighbours.items()
+        if identity not in skip
+    ]
+
+    print("Updating resources")
+    for kind, identities in by_kind(delta.removed).items():
+        write(
+            f"MATCH (n:{kind}) WHERE n.identity IN $ids DETACH DELETE n",
+            {"ids": identities},
+        )
+    for kind, identities in by_kind(delta.changed + rebound_entries).items():
+        write(
+            f"MATCH (n:{kind})-[r]-() WHERE n.identity IN $ids "
+            "WITH DISTINCT r DELETE r",
+            {"ids": identities},
+        )
+    with Writer() as writer:
+        for resource in list(base_resources()) + resources:
+            cmd, kwargs = create(resource)
+            writer.run(cmd, kwargs)
+
+    print("Updating relationships")
+    resolve_roles(resources)
+    edges = EdgeDeduplicator()
+    for initial in [True, False]:
+        with Writer() as writer:
+            for resource in resources:
+                relationship_generator(writer, initial, resource, edges)
+
+    index = NodeIndex()
+    for resource in resources:
+        index.add(resource.identity, resource.db_labels)
+    by_identity = {x.identity: x for x in resources}
+    scope = set(by_identity) | {x.identity for x in delta.removed}
+
+    sources = relationship_sources(neighbours.values(), entries + delta.removed)
+    resolve_roles(x for x in sources.values() if x.identity not in by_identity)
+    with Writer() as writer:
+        for identity, resource in tqdm(sources.items()):
+            if identity not in by_identity:
+                scoped_relationship_generator(
+                    writer,
+                    resource,
+                    index,
+                    by_identity,
+                    scope,
+                    edges,
+                )
+    print("")
+    edges.report()
+
+    if not attack_paths:
+        mark_attack_paths(False)
+        return
+
+    print("Updating attack paths")
+    if regenerate:
+        regenerate_attack_paths()
+    else:
+        affected = node_ids(entries, neighbours=True)
+        affected |= node_ids(old_neighbours, neighbours=False)
+        logger.info(f"Regenerating attack paths around {len(affected)} nodes")
+        update_attack_paths(sorted(affected))
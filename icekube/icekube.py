@@ -1,9 +1,19 @@
 import logging
-from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from typing import List, Optional
+from typing import (
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+    cast,
+)
 
 from icekube.attack_paths import attack_paths
+from icekube.index_planner import IndexSpec, plan_indices
 from icekube.kube import (
     all_resources,
     api_resources,
@@ -11,15 +21,35 @@ from icekube.kube import (
     kube_version,
 )
 from icekube.models import Cluster, Signer
-from icekube.models.base import Resource
-from icekube.neo4j import create, find, get, get_driver
-from neo4j import BoltDriver
+from icekube.models.base import ENDPOINT, Resource, ResourceRef
+from icekube.neo4j import (
+    Writer,
+    create,
+    find,
+    get,
+    get_driver,
+    resolve_roles,
+    write,
+)
+from icekube.reachability import (
+    PRINCIPAL_KINDS,
+    all_reachability_properties,
+    reachability_properties,
+    reachability_targets,
+)
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
 
 def create_indices():
+    kinds = {x.kind for x in api_resources()} | {Cluster.__name__}
+    with get_driver().session() as session:
+        for kind in sorted(kinds):
+            cmd = f"CREATE CONSTRAINT {kind.lower()}_identity IF NOT EXISTS "
+            cmd += f"FOR (n:{kind}) REQUIRE n.identity IS UNIQUE"
+            session.run(cmd)
+
     for resource in api_resources():
         if "list" not in resource.verbs:
             continue
@@ -37,119 +67,409 @@ def create_indices():
             session.run(cmd)
 
 
+def create_attack_path_indices(timeout: int = 300) -> None:
+    """Create indexes for the properties attack path queries filter on.
+
+    Indexes already created by `create_indices` are skipped, and this waits for
+    all indexes to come online so that attack path generation can use them.
+    """
+    existing: Set[IndexSpec] = set()
+    for resource in api_resources():
+        if "list" in resource.verbs:
+            if resource.namespaced:
+                existing.add((resource.kind, ("name", "namespace")))
+            else:
+                existing.add((resource.kind, ("name",)))
+
+    queries = [x for _, x in attack_path_queries()]
+    queries += list(reachability_targets.values())
+
+    with get_driver().session() as session:
+        for label, props in plan_indices(queries):
+            if (label, props) in existing:
+                continue
+
+            name = "_".join([label.lower(), *props])
+            on = ", ".join(f"n.{x}" for x in props)
+            cmd = f"CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON ({on})"
+            logger.info(f"Creating index {name}")
+            session.run(cmd)
+
+        session.run("CALL db.awaitIndexes($timeout)", timeout=timeout)
+
+
+def base_resources() -> Iterator[Resource]:
+    """Resources that are not listed from the cluster, but are always present."""
+    yield Cluster(apiVersion="N/A", name=context_name(), version=kube_version())
+
+    signers = [
+        "kubernetes.io/kube-apiserver-client",
+        "kubernetes.io/kube-apiserver-client-kubelet",
+        "kubernetes.io/kubelet-serving",
+        "kubernetes.io/legacy-unknown",
+    ]
+    for signer in signers:
+        yield Signer(name=signer)
+
+
 def enumerate_resource_kind(
     ignore: Optional[List[str]] = None,
 ):
     if ignore is None:
         ignore = []
 
-    with get_driver().session() as session:
-        cluster = Cluster(apiVersion="N/A", name=context_name(), version=kube_version())
-        cmd, kwargs = create(cluster)
-        session.run(cmd, **kwargs)
-
-        signers = [
-            "kubernetes.io/kube-apiserver-client",
-            "kubernetes.io/kube-apiserver-client-kubelet",
-            "kubernetes.io/kubelet-serving",
-            "kubernetes.io/legacy-unknown",
-        ]
-        for signer in signers:
-            s = Signer(name=signer)
-            cmd, kwargs = create(s)
-            session.run(cmd, **kwargs)
+    with Writer() as writer:
+        for resource in base_resources():
+            cmd, kwargs = create(resource)
+            writer.run(cmd, kwargs)
 
         for resource in all_resources(ignore=ignore):
             cmd, kwargs = create(resource)
-            session.run(cmd, **kwargs)
+            writer.run(cmd, kwargs, f"create {resource.kind}")
+
+
+def relationship_command(
+    source: ENDPOINT,
+    relationship: Union[str, List[str]],
+    target: ENDPOINT,
+) -> Tuple[str, Dict[str, Any]]:
+    if isinstance(source, (Resource, ResourceRef)):
+        src_cmd, src_kwargs = get(source, prefix="src")
+    else:
+        src_cmd = source[0].format(prefix="src")
+        src_kwargs = {f"src_{key}": value for key, value in source[1].items()}
+
+    if isinstance(target, (Resource, ResourceRef)):
+        dst_cmd, dst_kwargs = get(target, prefix="dst")
+    else:
+        dst_cmd = target[0].format(prefix="dst")
+        dst_kwargs = {f"dst_{key}": value for key, value in target[1].items()}
+
+    cmd = src_cmd + "WITH src " + dst_cmd
+
+    if isinstance(relationship, str):
+        relationship = [relationship]
+    cmd += "".join(f"MERGE (src)-[:{x}]->(dst) " for x in relationship)
+
+    return cmd, {**src_kwargs, **dst_kwargs}
+
+
+RESOURCE_KEY = Tuple[str, str, Optional[str], str]
+
+
+class EdgeDeduplicator:
+    """Skips relationships between resources that have already been merged.
+
+    Relationships to query endpoints are always written, as the query may match
+    nodes created since it was last run.
+    """
+
+    def __init__(self) -> None:
+        self.seen: Set[Tuple[RESOURCE_KEY, str, RESOURCE_KEY]] = set()
+        self.generated = 0
+        self.skipped = 0
+
+    @staticmethod
+    def key(resource: Union[Resource, ResourceRef]) -> RESOURCE_KEY:
+        # Rather than the resource itself, so resources are not kept in memory
+        return (resource.apiVersion, resource.kind, resource.namespace, resource.name)
+
+    def new_types(
+        self,
+        source: ENDPOINT,
+        relationship: Union[str, List[str]],
+        target: ENDPOINT,
+    ) -> List[str]:
+        """The relationship types between the endpoints not yet merged."""
+        types = [relationship] if isinstance(relationship, str) else relationship
+        self.generated += len(types)
+
+        if not isinstance(source, (Resource, ResourceRef)) or not isinstance(
+            target, (Resource, ResourceRef)
+        ):
+            return types
+
+        src, dst = self.key(source), self.key(target)
+        new = []
+        for x in types:
+            edge = (src, x, dst)
+            if edge in self.seen:
+                self.skipped += 1
+            else:
+                self.seen.add(edge)
+                new.append(x)
+        return new
+
+    def run(
+        self,
+        writer: Writer,
+        source: ENDPOINT,
+        relationship: Union[str, List[str]],
+        target: ENDPOINT,
+    ) -> None:
+        types = self.new_types(source, relationship, target)
+        if types:
+            writer.run(*relationship_command(source, types, target))
+
+    def report(self) -> None:
+        if self.generated:
+            print(
+                f"Skipped {self.skipped} of {self.generated} generated relationships "
+                f"as already merged",
+            )
 
 
 def relationship_generator(
-    driver: BoltDriver,
+    writer: Writer,
     initial: bool,
     resource: Resource,
+    edges: Optional[EdgeDeduplicator] = None,
 ):
-    with driver.session() as session:
-        logger.info(f"Generating relationships for {resource}")
-        for source, relationship, target in resource.relationships(initial):
-            logger.debug(
-                f"Creating relationship: {source} -> {relationship} -> {target}"
-            )
-            if isinstance(source, Resource):
-                src_cmd, src_kwargs = get(source, prefix="src")
-            else:
-                src_cmd = source[0].format(prefix="src")
-                src_kwargs = {f"src_{key}": value for key, value in source[1].items()}
-
-            if isinstance(target, Resource):
-                dst_cmd, dst_kwargs = get(target, prefix="dst")
-            else:
-                dst_cmd = target[0].format(prefix="dst")
-                dst_kwargs = {f"dst_{key}": value for key, value in target[1].items()}
-
-            cmd = src_cmd + "WITH src " + dst_cmd
+    logger.info(f"Generating relationships for {resource}")
+    for source, relationship, target in resource.relationships(initial):
+        logger.debug(f"Creating relationship: {source} -> {relationship} -> {target}")
+        if edges is not None:
+            edges.run(writer, source, relationship, target)
+            continue
+        cmd, kwargs = relationship_command(source, relationship, target)
+        logger.debug(f"Starting neo4j query: {cmd}, {kwargs}")
+        writer.run(cmd, kwargs)
 
-            if isinstance(relationship, str):
-                relationship = [relationship]
-            cmd += "".join(f"MERGE (src)-[:{x}]->(dst) " for x in relationship)
 
-            kwargs = {**src_kwargs, **dst_kwargs}
-            logger.debug(f"Starting neo4j query: {cmd}, {kwargs}")
-            session.run(cmd, kwargs)
+def with_roles(
+    resources: Iterable[Resource],
+    batch_size: int = 1000,
+) -> Iterator[Resource]:
+    """Resolve the roles of bindings in batches, rather than one at a time."""
+    batch: List[Resource] = []
+    for resource in resources:
+        batch.append(resource)
+        if len(batch) >= batch_size:
+            resolve_roles(batch)
+            yield from batch
+            batch = []
+    resolve_roles(batch)
+    yield from batch
 
 
-def generate_relationships(threaded: bool = False) -> None:
+def generate_relationships() -> None:
     logger.info("Generating relationships")
     logger.info("Fetching resources from neo4j")
-    driver = get_driver()
     resources = find()
     logger.info("Fetched resources from neo4j")
-    generator = partial(relationship_generator, driver, True)
 
-    if threaded:
-        with ThreadPoolExecutor() as exc:
-            exc.map(generator, resources)
-    else:
-        print("First pass for relationships")
-        for resource in tqdm(resources):
-            generator(resource)
-        print("")
+    # Relationships written in the first pass are repeated in the second
+    edges = EdgeDeduplicator()
 
-    # Do a second loop across relationships to handle objects created as part
-    # of other relationships
+    print("First pass for relationships")
+    with Writer() as writer:
+        for resource in tqdm(with_roles(resources)):
+            relationship_generator(writer, True, resource, edges)
+    print("")
 
-    resources = find()
-    generator = partial(relationship_generator, driver, False)
+    # Do a second loop across relationships to handle objects created as part
+    # of other relationships. The first pass has to be written in full before
+    # fetching the resources again.
 
-    if threaded:
-        with ThreadPoolExecutor() as exc:
-            exc.map(generator, resources)
-    else:
-        print("Second pass for relationships")
-        for resource in tqdm(resources):
-            generator(resource)
-        print("")
+    print("Second pass for relationships")
+    with Writer() as writer:
+        for resource in tqdm(with_roles(find())):
+            relationship_generator(writer, False, resource, edges)
+    print("")
+    edges.report()
 
 
 def remove_attack_paths() -> None:
+    write("MATCH ()-[r]-() WHERE r.attack_path IS NOT NULL DELETE r")
+
+
+def mark_attack_paths(current: bool) -> None:
+    """Record on the cluster whether its attack paths match its resources."""
+    write(
+        "MATCH (n:Cluster { name: $name }) SET n.attack_paths_current = $current",
+        {"name": context_name(), "current": current},
+    )
+
+
+def attack_paths_current() -> bool:
+    """Whether attack paths were generated since the resources last changed."""
+    cmd = "MATCH (n:Cluster { name: $name }) RETURN n.attack_paths_current"
     with get_driver().session() as session:
-        session.run("MATCH ()-[r]-() WHERE r.attack_path IS NOT NULL DELETE r")
+        result = session.run(cmd, name=context_name()).single()
+    return bool(result and result[0])
+
+
+def attack_path_queries() -> Iterator[Tuple[str, str]]:
+    """Each attack path query, finishing with the relationship to be created.
+
+    Queries are named after the relationship they create, with the position of
+    the query appended where a relationship is created by multiple queries.
+    """
+    for relationship, query in attack_paths.items():
+        if isinstance(query, str):
+            names = [relationship]
+            query = [query]
+        else:
+            names = [f"{relationship}[{idx}]" for idx in range(len(query))]
+        for name, q in zip(names, query):
+            yield name, (
+                q + f" MERGE (src)-[:{relationship} {{ attack_path: 1 }}]->(dest)"
+            )
+
+
+def reads_attack_paths(cmd: str) -> bool:
+    """Whether an attack path query matches on previously created attack paths."""
+    return "attack_path" in cmd.rsplit(" MERGE ", 1)[0]
+
+
+def ordered_attack_path_queries() -> List[List[Tuple[str, str]]]:
+    """Attack path queries split into groups that can run concurrently.
+
+    Queries that build on other attack paths are run after the rest.
+    """
+    queries = list(attack_path_queries())
+    return [
+        [x for x in queries if not reads_attack_paths(x[1])],
+        [x for x in queries if reads_attack_paths(x[1])],
+    ]
 
 
 def setup_attack_paths() -> None:
     print("Generating attack paths")
-    for relationship, query in tqdm(attack_paths.items()):
-        with get_driver().session() as session:
-            if isinstance(query, str):
-                query = [query]
-            for q in query:
-                cmd = q + f" MERGE (src)-[:{relationship} {{ attack_path: 1 }}]->(dest)"
+    with tqdm(total=len(list(attack_path_queries()))) as progress:
+        for group in ordered_attack_path_queries():
+            with Writer(batch_size=1) as writer:
+                for name, cmd in group:
+                    future = writer.run(cmd, name=name)
+                    future.add_done_callback(lambda _: progress.update())
+    print("")
+
+
+def find_starting_points(
+    namespaces: List[str],
+    groups: List[str],
+    users: List[str],
+) -> List[int]:
+    cmd = (
+        "MATCH (n) WHERE ((n:ServiceAccount OR n:Pod) AND n.namespace IN $namespaces) "
+        "OR (n:Group AND n.name IN $groups) OR (n:User AND n.name IN $users) "
+        "RETURN id(n)"
+    )
+    with get_driver().session() as session:
+        return cast(
+            List[int],
+            session.run(cmd, namespaces=namespaces, groups=groups, users=users).value(),
+        )
 
-                session.run(cmd)
+
+def setup_attack_paths_from(start: List[int]) -> None:
+    """Generate attack paths reachable from a set of starting nodes only.
+
+    The attack path queries are evaluated with their source restricted to the
+    current frontier, starting with `start`. Destinations not seen before form
+    the next frontier, and this repeats until nothing new is reached.
+    """
+    print("Generating attack paths from starting points")
+    visited = set(start)
+    frontier = set(start)
+    depth = 0
+
+    while frontier:
+        depth += 1
+        reached: Set[int] = set()
+
+        for group in ordered_attack_path_queries():
+            with Writer(batch_size=1) as writer:
+                futures = [
+                    writer.run(
+                        "MATCH (src) WHERE id(src) IN $frontier WITH src "
+                        + query
+                        + " RETURN DISTINCT id(dest)",
+                        {"frontier": list(frontier)},
+                        name,
+                    )
+                    for name, query in group
+                ]
+            for future in futures:
+                reached.update(x[0] for x in future.result())
+
+        frontier = reached - visited
+        visited |= frontier
+        logger.info(f"Reached {len(frontier)} new nodes at depth {depth}")
+
+    print(f"Reached {len(visited)} nodes from {len(start)} starting points")
+
+
+def remove_reachability() -> None:
+    props = ", ".join(f"n.{x}" for x in all_reachability_properties())
+    write(f"MATCH (n) REMOVE {props}")
+
+
+def setup_reachability(max_hops: int = 25) -> None:
+    """Precompute the distance from every node to each crown-jewel target.
+
+    A breadth-first search is performed backwards from all targets of a kind at
+    once over the attack path relationships. Each node that can reach a target
+    stores the number of hops to the closest one, the next node on that route,
+    and the attack path used to get there.
+    """
+    print("Generating reachability index")
+    for target, query in tqdm(reachability_targets.items()):
+        hops, next_hop, via = reachability_properties(target)
+
+        write(f"{query} SET target.{hops} = 0", name=hops)
+
+        for depth in range(1, max_hops + 1):
+            cmd = (
+                f"MATCH (nxt) WHERE nxt.{hops} = $previous "
+                "MATCH (src)-[r]->(nxt) "
+                f"WHERE r.attack_path IS NOT NULL AND src.{hops} IS NULL "
+                "WITH src, head(collect([id(nxt), type(r)])) AS step "
+                f"SET src.{hops} = $depth, src.{next_hop} = step[0], "
+                f"src.{via} = step[1] "
+                "RETURN count(src)"
+            )
+            reached = write(cmd, {"previous": depth - 1, "depth": depth}, hops)[0][0]
+            logger.debug(f"Reached {reached} new nodes for {target} at {depth}")
+            if not reached:
+                break
     print("")
 
 
-def purge_neo4j() -> None:
+def reachable_paths(
+    target: str,
+    **kwargs: str,
+) -> Iterator[List[Tuple[Resource, Optional[str]]]]:
+    """Paths to a crown-jewel target, read from the reachability index.
+
+    Without any filters, every principal able to reach the target is returned,
+    closest first. Each path is a list of resources paired with the attack path
+    taken from that resource to the next one in the list.
+    """
+    hops, next_hop, via = reachability_properties(target)
+
+    labels = [f"{key}: ${key}" for key in kwargs.keys()]
+    cmd = f"MATCH (src {{ {', '.join(labels)} }}) WHERE src.{hops} IS NOT NULL "
+    if not kwargs:
+        cmd += "AND (" + " OR ".join(f"src:{x}" for x in PRINCIPAL_KINDS) + ") "
+    cmd += f"RETURN src ORDER BY src.{hops}"
+
+    step_cmd = "MATCH (n) WHERE id(n) = $id RETURN n"
+
     with get_driver().session() as session:
-        session.run("MATCH (x)-[r]-(y) DELETE x, r, y")
-        session.run("MATCH (x) DELETE x")
+        logger.debug(f"Starting neo4j query: {cmd}, {kwargs}")
+        for result in session.run(cmd, kwargs).value():
+            node = result._properties
+            path: List[Tuple[Resource, Optional[str]]] = []
+
+            while node.get(hops):
+                path.append((Resource(**node), node[via]))
+                node = session.run(step_cmd, id=node[next_hop]).single()[0]._properties
+            path.append((Resource(**node), None))
+
+            yield path
+
+
+def purge_neo4j() -> None:
+    write("MATCH (x)-[r]-(y) DELETE x, r, y")
+    write("MATCH (x) DELETE x")
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import re
+from typing import Any, Dict, Iterable, List, Set, Tuple
+
+from icekube.models import Resource
+
+STRING_LITERAL = re.compile(r"'[^']*'|\"[^\"]*\"")
+NODE_PATTERN = re.compile(r"\((\w*):(\w+)\s*(?:\{([^}]*)\})?\s*\)")
+MAP_KEY = re.compile(r"(\w+)\s*:")
+PROPERTY_REFERENCE = re.compile(r"\b(\w+)\.(\w+)\b")
+
+IndexSpec = Tuple[str, Tuple[str, ...]]
+
+
+def query_predicates(query: str) -> Set[IndexSpec]:
+    """Find the label and properties a query filters nodes on.
+
+    Inline property maps on labelled nodes, e.g. `(src:Pod {privileged: true})`,
+    give a (composite) index over the map keys. Properties referenced elsewhere
+    through a variable bound to a label, e.g. `ns.psa_enforce` when the query has
+    `(ns:Namespace)`, give a single property index.
+    """
+    query = STRING_LITERAL.sub("''", query)
+    found: Set[IndexSpec] = set()
+    variables: Dict[str, str] = {}
+
+    for variable, label, properties in NODE_PATTERN.findall(query):
+        if variable:
+            variables.setdefault(variable, label)
+        keys = tuple(sorted(MAP_KEY.findall(properties or "")))
+        if keys:
+            found.add((label, keys))
+
+    for variable, prop in PROPERTY_REFERENCE.findall(query):
+        if variable in variables:
+            found.add((variables[variable], (prop,)))
+
+    return found
+
+
+def model_properties(label: str) -> Dict[str, Any]:
+    """Sample the properties that are saved to neo4j for nodes with a label."""
+    model = next(
+        (x for x in Resource.__subclasses__() if x.__name__ == label),
+        Resource,
+    )
+    sample = model.model_construct(
+        apiVersion="v1",
+        kind=label,
+        name="",
+        namespace="default",
+        plural="",
+        raw="{}",
+        version="",
+    )
+    return sample.db_labels
+
+
+def plan_indices(queries: Iterable[str]) -> List[IndexSpec]:
+    """Indexes to create so that the given queries can find nodes directly.
+
+    Only properties that are saved by the model for a label are considered, and
+    list properties are skipped as they cannot be served by a property index.
+    """
+    planned: Set[IndexSpec] = set()
+    for query in queries:
+        planned.update(query_predicates(query))
+
+    properties: Dict[str, Dict[str, Any]] = {}
+    indices = []
+    for label, keys in sorted(planned):
+        if label not in properties:
+            properties[label] = model_properties(label)
+        saved = properties[label]
+
+        if all(k in saved and not isinstance(saved[k], list) for k in keys):
+            indices.append((label, keys))
+
+    return indices
@@ -1,6 +1,6 @@
 import logging
 from collections.abc import Iterator
-from typing import Any, Dict, List, Optional, cast
+from typing import Any, Dict, List, Optional, Set, Tuple, cast
 
 from icekube.models import APIResource, Resource
 from kubernetes import client, config
@@ -148,7 +148,15 @@ def api_resources() -> List[APIResource]:
 def all_resources(
     preferred_versions_only: bool = True,
     ignore: Optional[List[str]] = None,
+    listed: Optional[Set[Tuple[str, Optional[str]]]] = None,
 ) -> Iterator[Resource]:
+    """Every resource within the cluster.
+
+    Kinds or namespaces that fail to list are logged and skipped. If `listed`
+    is given, each kind and namespace listed successfully is added to it, with
+    a namespace of None once every namespace of a kind, or a cluster wide kind,
+    is listed.
+    """
     load_kube_config()
 
     if ignore is None:
@@ -170,27 +178,37 @@ def all_resources(
             continue
 
         logger.info(f"Fetching {resource_kind.name} resources")
-        try:
-            resource_class = Resource.get_kind_class(
-                resource_kind.group,
-                resource_kind.kind,
-            )
-            if resource_kind.namespaced:
-                for ns in all_namespaces:
-                    yield from resource_class.list(
-                        resource_kind.group,
-                        resource_kind.kind,
-                        resource_kind.name,
-                        ns,
-                    )
-            else:
-                yield from resource_class.list(
+        resource_class = Resource.get_kind_class(
+            resource_kind.group,
+            resource_kind.kind,
+        )
+        namespaces: List[Optional[str]] = [None]
+        if resource_kind.namespaced:
+            namespaces = list(all_namespaces)
+
+        failed = False
+        for ns in namespaces:
+            try:
+                resources = resource_class.list(
                     resource_kind.group,
                     resource_kind.kind,
                     resource_kind.name,
+                    ns,
                 )
-        except client.exceptions.ApiException:
-            logger.error(f"Failed to retrieve {resource_kind.name}")
+            except client.exceptions.ApiException:
+                logger.error(
+                    f"Failed to retrieve {resource_kind.name}"
+                    + (f" within {ns}" if ns else ""),
+                )
+                failed = True
+                continue
+
+            if listed is not None:
+                listed.add((resource_kind.kind, ns))
+            yield from resources
+
+        if listed is not None and not failed:
+            listed.add((resource_kind.kind, None))
     print("")
 
 
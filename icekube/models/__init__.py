@@ -3,6 +3,7 @@ from icekube.models import (
     clusterrolebinding,
     group,
     namespace,
+    node,
     pod,
     role,
     rolebinding,
@@ -25,6 +26,7 @@ __all__ = [
     "clusterrolebinding",
     "group",
     "namespace",
+    "node",
     "pod",
     "role",
     "rolebinding",
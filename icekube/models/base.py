@@ -1,13 +1,32 @@
 from __future__ import annotations
 
+import hashlib
 import json
 import logging
 import traceback
-from functools import cached_property
-from typing import Any, Dict, List, Optional, Tuple, Type, Union, cast
+from functools import cached_property, lru_cache
+from itertools import repeat
+from typing import (
+    Any,
+    Callable,
+    ClassVar,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+)
+from weakref import WeakValueDictionary
 
+from icekube.blobstore import raw_store
+from icekube.config import config
 from icekube.models._helpers import load, save
 from icekube.relationships import Relationship
+from icekube.trimming import trim_item, trim_paths, trim_report
 from icekube.utils import to_camel_case
 from kubernetes import client
 from pydantic import (
@@ -17,9 +36,40 @@ from pydantic import (
     field_validator,
     model_validator,
 )
+from pydantic_core import CoreSchema, core_schema
 
 logger = logging.getLogger(__name__)
 
+# Metadata updated on every write to a resource, even when nothing else changes
+VOLATILE_METADATA = ["managedFields", "resourceVersion"]
+
+# Core kinds listed with only their metadata, as nothing reads the rest of them
+METADATA_ONLY_KINDS = ["ConfigMap", "Secret"]
+
+# Fields of metadata only kinds that are implied by a field selector. Objects
+# matching the selector are listed again, with only their metadata, to set them.
+# Further secret types can be recovered with --secret-type
+IMPLIED_FIELDS: Dict[str, List[Tuple[str, Dict[str, Any]]]] = {
+    "Secret": [
+        (
+            "type=kubernetes.io/service-account-token",
+            {"type": "kubernetes.io/service-account-token"},
+        ),
+    ],
+}
+
+# Objects of metadata only kinds needed in full, by namespace and name
+FULL_OBJECTS: Dict[str, List[Tuple[str, str]]] = {
+    "ConfigMap": [("kube-system", "aws-auth")],
+}
+
+METADATA_ONLY_ACCEPT = (
+    "application/json;as=PartialObjectMetadataList;v=v1;g=meta.k8s.io,"
+    "application/json"
+)
+
+T = TypeVar("T", bound=BaseModel)
+
 
 def api_group(api_version: str) -> str:
     if "/" in api_version:
@@ -28,6 +78,136 @@ def api_group(api_version: str) -> str:
     return ""
 
 
+def identity_hash(unique_identifiers: Dict[str, str]) -> str:
+    data = json.dumps(unique_identifiers, sort_keys=True).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def field_validators(model: Type[BaseModel]) -> Dict[str, List[Callable[[Any], Any]]]:
+    """The field validators of a model, which only take the value, by field."""
+    validators: Dict[str, List[Callable[[Any], Any]]] = {}
+    for decorator in model.__pydantic_decorators__.field_validators.values():
+        if decorator.info.mode not in ["before", "after"]:
+            continue
+        for field in decorator.info.fields:
+            validators.setdefault(field, []).append(decorator.func)
+    return validators
+
+
+def run_field_validators(model: Type[BaseModel], values: Dict[str, Any]) -> None:
+    for field, validators in field_validators(model).items():
+        if field in values:
+            for validator in validators:
+                values[field] = validator(values[field])
+
+
+@lru_cache(maxsize=None)
+def model_defaults(
+    model: Type[BaseModel],
+) -> Tuple[Dict[str, Any], Dict[str, Callable[[], Any]]]:
+    """Default values of the optional fields of a model, and default factories."""
+    defaults: Dict[str, Any] = {}
+    factories: Dict[str, Callable[[], Any]] = {}
+    for name, field in model.model_fields.items():
+        if field.default_factory is not None:
+            factories[name] = field.default_factory
+        elif not field.is_required():
+            defaults[name] = field.default
+    return defaults, factories
+
+
+@lru_cache(maxsize=None)
+def eager_fields(model: Type[BaseModel]) -> List[str]:
+    """The cached properties of a model, which are derived from its raw data."""
+    fields: List[str] = []
+    for cls in reversed(model.__mro__):
+        for name, value in vars(cls).items():
+            if isinstance(value, cached_property) and name not in fields:
+                fields.append(name)
+    return fields
+
+
+def list_core_items(
+    plural: str,
+    namespace: Optional[str] = None,
+    field_selector: Optional[str] = None,
+    metadata_only: bool = False,
+) -> List[Dict[str, Any]]:
+    """List the items of a core v1 kind, optionally with only their metadata."""
+    path = "/api/v1"
+    if namespace:
+        path += f"/namespaces/{namespace}"
+    path += f"/{plural}"
+
+    resp = client.ApiClient().call_api(
+        path,
+        "GET",
+        query_params=[("fieldSelector", field_selector)] if field_selector else [],
+        header_params={
+            "Accept": METADATA_ONLY_ACCEPT if metadata_only else "application/json",
+        },
+        auth_settings=["BearerToken"],
+        _preload_content=False,
+        _return_http_data_only=True,
+    )
+    return cast(List[Dict[str, Any]], json.loads(resp.data).get("items", []))
+
+
+def list_metadata_only(
+    kind: str,
+    plural: str,
+    namespace: Optional[str] = None,
+) -> List[Dict[str, Any]]:
+    """List the items of a metadata only kind.
+
+    Their bodies are never transferred, apart from the few objects needed in
+    full, such as the `aws-auth` ConfigMap.
+    """
+
+    def key(item: Dict[str, Any]) -> Tuple[Optional[str], str]:
+        return item["metadata"].get("namespace"), item["metadata"]["name"]
+
+    items = {key(x): x for x in list_core_items(plural, namespace, None, True)}
+
+    implied = IMPLIED_FIELDS.get(kind, [])
+    if kind == "Secret":
+        implied = implied + [(f"type={x}", {"type": x}) for x in config["secret_types"]]
+
+    for field_selector, fields in implied:
+        for item in list_core_items(plural, namespace, field_selector, True):
+            if key(item) in items:
+                items[key(item)].update(fields)
+
+    for ns, name in FULL_OBJECTS.get(kind, []):
+        if namespace in [None, ns]:
+            for item in list_core_items(plural, ns, f"metadata.name={name}"):
+                items[key(item)] = item
+
+    return list(items.values())
+
+
+def construct(model: Type[T], values: Dict[str, Any]) -> T:
+    """Build a model from trusted values, like `model_construct`.
+
+    `model_construct` deep copies default values for every instance, which
+    dominates the time taken. Here default values are shared between instances
+    instead, so must never be modified.
+    """
+    defaults, factories = model_defaults(model)
+    fields = {**defaults, **{k: f() for k, f in factories.items() if k not in values}}
+    fields.update(values)
+
+    instance = object.__new__(model)
+    object.__setattr__(instance, "__dict__", fields)
+    object.__setattr__(instance, "__pydantic_fields_set__", set(values))
+    object.__setattr__(instance, "__pydantic_extra__", None)
+    object.__setattr__(instance, "__pydantic_private__", None)
+    if model.__pydantic_post_init__:
+        instance.model_post_init(None)
+    return instance
+
+
 class Resource(BaseModel):
     apiVersion: str = Field(default=...)
     kind: str = Field(default=...)
@@ -35,6 +215,7 @@ class Resource(BaseModel):
     plural: str = Field(default=...)
     namespace: Optional[str] = Field(default=None)
     raw: Optional[str] = Field(default=None)
+    raw_ref: Optional[str] = Field(default=None)
     supported_api_groups: List[str] = Field(default_factory=list)
 
     def __new__(cls, **kwargs):
@@ -54,22 +235,77 @@ class Resource(BaseModel):
         return self.__repr__()
 
     def __eq__(self, other) -> bool:
+        if isinstance(other, ResourceRef):
+            return other == self
+
         comparison_points = ["apiVersion", "kind", "namespace", "name"]
 
         return all(getattr(self, x) == getattr(other, x) for x in comparison_points)
 
+    def __hash__(self) -> int:
+        return hash((self.kind, self.namespace, self.name))
+
     @field_validator("kind")
     @classmethod
     def kind_can_only_have_underscore(cls, v: str) -> str:
         s = "".join([x if x.isalnum() else "_" for x in v])
         return s
 
-    @cached_property
+    @model_validator(mode="after")
+    def extract_after_validation(self) -> Resource:
+        self.extract_fields()
+        return self
+
+    def extract_fields(self, parsed: Optional[Dict[str, Any]] = None) -> None:
+        """Compute the fields derived from the raw resource, parsing it only once.
+
+        `parsed` is the raw resource if it has already been parsed. It is then
+        discarded, so only the raw JSON and the derived fields are held in
+        memory. Resources without a raw resource are left to compute their
+        fields when used, as are those built with `model_construct`. So are
+        those only holding a `raw_ref`, such as nodes read back from neo4j, so
+        their payload is only read from the raw store if a field is used.
+        """
+        if parsed is None:
+            if self.raw is None:
+                return
+            parsed = cast(Dict[str, Any], json.loads(self.raw))
+
+        self.__dict__["_parsed"] = parsed
+        try:
+            for name in eager_fields(type(self)):
+                getattr(self, name)
+        finally:
+            del self.__dict__["_parsed"]
+
+    @property
     def data(self) -> Dict[str, Any]:
-        return cast(Dict[str, Any], json.loads(self.raw or "{}"))
+        """The parsed raw resource, only to be read by derived fields.
+
+        Derived fields are cached properties. If they were not computed upfront,
+        the first one used computes all of them, so that the raw resource is
+        only parsed once.
+        """
+        parsed = self.__dict__.get("_parsed")
+        if parsed is None:
+            parsed = self.load_data()
+            self.extract_fields(parsed)
+        return cast(Dict[str, Any], parsed)
+
+    def load_data(self) -> Dict[str, Any]:
+        raw = self.raw
+        if raw is None and self.raw_ref:
+            # Saved to neo4j with only a reference to the raw payload
+            store = raw_store()
+            if store is None:
+                raise ValueError(
+                    f"{self} was saved with --raw-store, which is needed to read it",
+                )
+            raw = store.get(self.raw_ref)
+        return cast(Dict[str, Any], json.loads(raw or "{}"))
 
     @computed_field  # type: ignore
-    @property
+    @cached_property
     def labels(self) -> Dict[str, str]:
         return cast(Dict[str, str], self.data.get("metadata", {}).get("labels", {}))
 
@@ -159,14 +395,121 @@ class Resource(BaseModel):
             ident["namespace"] = self.namespace
         return ident
 
+    @property
+    def identity(self) -> str:
+        """A compact key derived from the unique identifiers of the resource."""
+        return identity_hash(self.unique_identifiers)
+
+    @cached_property
+    def content_hash(self) -> str:
+        """A hash of the raw resource, ignoring metadata changed by every write."""
+        metadata = {
+            key: value
+            for key, value in self.data.get("metadata", {}).items()
+            if key not in VOLATILE_METADATA
+        }
+        data = json.dumps(
+            {**self.data, "metadata": metadata},
+            sort_keys=True,
+            separators=(",", ":"),
+            default=str,
+        ).encode()
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    @cached_property
+    def resource_version(self) -> Optional[str]:
+        """The resourceVersion of the raw resource, if it has one."""
+        return cast(
+            Optional[str],
+            self.data.get("metadata", {}).get("resourceVersion"),
+        )
+
     @property
     def db_labels(self) -> Dict[str, Any]:
         return {
             **self.unique_identifiers,
             "plural": self.plural,
             "raw": self.raw,
+            "content_hash": self.content_hash,
         }
 
+    @classmethod
+    def trusted(cls, **values: Any) -> Resource:
+        """Build a resource from values known to be valid, such as from the API.
+
+        This skips the validation performed when creating a resource normally,
+        including looking up the apiVersion, kind and plural, which must all be
+        given. Field validators that transform values, such as removing the data
+        from secrets, are still run.
+        """
+        kind_class = cls.get_kind_class(values["apiVersion"], values["kind"])
+        run_field_validators(kind_class, values)
+        resource = construct(kind_class, values)
+        resource.extract_fields()
+        return resource
+
+    @classmethod
+    def from_list_items(
+        cls,
+        apiVersion: str,
+        kind: str,
+        plural: str,
+        items: Iterable[Dict[str, Any]],
+        raws: Optional[Iterable[str]] = None,
+    ) -> List[Resource]:
+        """Build resources for the items of a list response from the API.
+
+        This is the same as calling `trusted` for each item, with the values
+        shared between items only validated once. `raws` holds the JSON of each
+        item if it is already known, otherwise the items are serialised. Items
+        that fail to build are logged and skipped. Fields unused by IceKube are
+        trimmed from items first, following the profile for the kind.
+        """
+        kind_class = cls.get_kind_class(apiVersion, kind)
+        shared = {"apiVersion": apiVersion, "kind": kind, "plural": plural}
+        run_field_validators(kind_class, shared)
+        # Items can stand in for their parsed raw JSON, unless it is modified
+        reuse_items = "raw" not in field_validators(kind_class)
+        paths = trim_paths(kind)
+        trimmed = saved = 0
+
+        pairs: Iterable[Tuple[Dict[str, Any], Optional[str]]] = zip(
+            items,
+            repeat(None) if raws is None else raws,
+        )
+
+        resources: List[Resource] = []
+        for item, raw in pairs:
+            removed = trim_item(item, paths) if paths else 0
+            if removed:
+                trimmed += 1
+                saved += removed
+            if removed or raw is None:
+                raw = json.dumps(item, default=str)
+
+            metadata = item.get("metadata", {})
+            try:
+                values = {
+                    "name": metadata["name"],
+                    "namespace": metadata.get("namespace"),
+                    "raw": raw,
+                }
+                run_field_validators(kind_class, values)
+                resource = construct(kind_class, {**shared, **values})
+                resource.extract_fields(item if reuse_items else None)
+                resources.append(resource)
+            except Exception:
+                logger.error(
+                    f"Error when processing {kind} - "
+                    f"{metadata.get('namespace', '')}:{metadata.get('name')}",
+                )
+                traceback.print_exc()
+
+        if trimmed:
+            trim_report.record(kind, trimmed, saved)
+
+        return resources
+
     @classmethod
     def list(
         cls: Type[Resource],
@@ -181,7 +524,6 @@ class Resource(BaseModel):
             # Core v1 API
             group = None
             version = apiVersion
-        resources: List[Resource] = []
         if group:
             if namespace:
                 resp = client.CustomObjectsApi().list_namespaced_custom_object(
@@ -196,6 +538,8 @@ class Resource(BaseModel):
                     version,
                     name,
                 )
+        elif kind in METADATA_ONLY_KINDS:
+            resp = {"items": list_metadata_only(kind, name, namespace)}
         else:
             if namespace:
                 func = f"list_namespaced_{to_camel_case(kind)}"
@@ -211,29 +555,12 @@ class Resource(BaseModel):
                     getattr(client.CoreV1Api(), func)(_preload_content=False).data,
                 )
 
-        for item in resp.get("items", []):
+        items = resp.get("items", [])
+        for item in items:
             item["apiVersion"] = apiVersion
             item["kind"] = kind
-            try:
-                resources.append(
-                    Resource(
-                        apiVersion=apiVersion,
-                        kind=kind,
-                        name=item["metadata"]["name"],
-                        namespace=item["metadata"]["namespace"] if namespace else None,
-                        plural=name,
-                        raw=json.dumps(item, default=str),
-                    ),
-                )
-            except Exception:
-                logger.error(
-                    f"Error when processing {kind} - "
-                    f"{item['metadata'].get('namespace', '')}:"
-                    f"{item['metadata']['name']}",
-                )
-                traceback.print_exc()
 
-        return resources
+        return cls.from_list_items(apiVersion, kind, name, items)
 
     def relationships(
         self,
@@ -245,7 +572,7 @@ class Resource(BaseModel):
         relationships: List[RELATIONSHIP] = []
 
         if self.namespace is not None:
-            ns = Resource(name=self.namespace, kind="Namespace")
+            ns = ResourceRef("Namespace", self.namespace)
             relationships += [
                 (
                     self,
@@ -257,10 +584,155 @@ class Resource(BaseModel):
         return relationships
 
 
+@lru_cache(maxsize=None)
+def resolve_api_resource(kind: str) -> Tuple[str, str, str]:
+    """The apiVersion, kind and plural given to resources of a kind."""
+    resource = Resource(name="", kind=kind)
+    return resource.apiVersion, resource.kind, resource.plural
+
+
+class ResourceRef:
+    """A lightweight reference to a resource, used as a relationship endpoint.
+
+    This only holds what is needed to find or create the resource in neo4j.
+    References are interned, so identical references share the same object.
+    The apiVersion and plural of the kind are only looked up when first used,
+    so creating, hashing, comparing or serialising a reference never queries
+    the API.
+    """
+
+    __slots__ = [
+        "kind",
+        "name",
+        "namespace",
+        "_api_version",
+        "_plural",
+        "_identity",
+        "__weakref__",
+    ]
+
+    interned: ClassVar[
+        WeakValueDictionary[Tuple[str, str, Optional[str]], ResourceRef]
+    ] = WeakValueDictionary()
+
+    kind: str
+    name: str
+    namespace: Optional[str]
+    _api_version: Optional[str]
+    _plural: Optional[str]
+    _identity: Optional[str]
+
+    def __new__(
+        cls,
+        kind: str,
+        name: str,
+        namespace: Optional[str] = None,
+    ) -> ResourceRef:
+        key = (kind, name, namespace)
+        ref = cls.interned.get(key)
+        if ref is None:
+            ref = super().__new__(cls)
+            ref.kind = kind
+            ref.name = name
+            ref.namespace = namespace
+            ref._api_version = ref._plural = ref._identity = None
+            cls.interned[key] = ref
+        return ref
+
+    @property
+    def apiVersion(self) -> str:
+        if self._api_version is None:
+            self._api_version, _, self._plural = resolve_api_resource(self.kind)
+        return self._api_version
+
+    @property
+    def plural(self) -> str:
+        if self._plural is None:
+            self._api_version, _, self._plural = resolve_api_resource(self.kind)
+        return self._plural
+
+    @property
+    def identity(self) -> str:
+        if self._identity is None:
+            self._identity = identity_hash(self.unique_identifiers)
+        return self._identity
+
+    def __repr__(self) -> str:
+        if self.namespace:
+            return f"{self.kind}(namespace='{self.namespace}', name='{self.name}')"
+        else:
+            return f"{self.kind}(name='{self.name}')"
+
+    def __eq__(self, other) -> bool:
+        # The apiVersion is left out, so comparing a reference does not look it up
+        comparison_points = ["kind", "namespace", "name"]
+
+        return all(getattr(self, x) == getattr(other, x) for x in comparison_points)
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        # Interned again when unpickled, such as from snapshot loading processes
+        return (ResourceRef, (self.kind, self.name, self.namespace))
+
+    def __hash__(self) -> int:
+        # Matches Resource, which compares equal to refs to the same resource.
+        # The apiVersion is left out, so hashing a reference does not look it up
+        return hash((self.kind, self.namespace, self.name))
+
+    @classmethod
+    def __get_pydantic_core_schema__(cls, source: Any, handler: Any) -> CoreSchema:
+        return core_schema.is_instance_schema(
+            cls,
+            serialization=core_schema.plain_serializer_function_ser_schema(
+                lambda x: x.held_identifiers,
+            ),
+        )
+
+    @property
+    def api_group(self) -> str:
+        return api_group(self.apiVersion)
+
+    @property
+    def held_identifiers(self) -> Dict[str, str]:
+        """The identifiers held by the reference, without looking any up."""
+        ident = {"kind": self.kind, "name": self.name}
+        if self.namespace:
+            ident["namespace"] = self.namespace
+        return ident
+
+    @property
+    def unique_identifiers(self) -> Dict[str, str]:
+        ident = {
+            "apiGroup": self.api_group,
+            "apiVersion": self.apiVersion,
+            "kind": self.kind,
+            "name": self.name,
+        }
+        if self.namespace:
+            ident["namespace"] = self.namespace
+        return ident
+
+    def resource(self) -> Resource:
+        """The full model of the resource, without its raw JSON."""
+        return Resource.trusted(
+            apiVersion=self.apiVersion,
+            kind=self.kind,
+            name=self.name,
+            namespace=self.namespace,
+            plural=self.plural,
+        )
+
+    def relationships(self, initial: bool = True) -> List[RELATIONSHIP]:
+        return self.resource().relationships(initial)
+
+
+def clear_resource_refs() -> None:
+    """Forget resolved kinds, after the API resources available have changed."""
+    resolve_api_resource.cache_clear()
+    ResourceRef.interned.clear()
+
+
 QUERY_RESOURCE = Tuple[str, Dict[str, str]]
 
-RELATIONSHIP = Tuple[
-    Union[Resource, QUERY_RESOURCE],
-    Union[str, List[str]],
-    Union[Resource, QUERY_RESOURCE],
-]
+ENDPOINT = Union[Resource, ResourceRef, QUERY_RESOURCE]
+
+RELATIONSHIP = Tuple[ENDPOINT, Union[str, List[str]], ENDPOINT]
@@ -3,54 +3,59 @@ from __future__ import annotations
 from functools import cached_property
 from typing import Any, Dict, List, Optional, Union
 
-from icekube.models.base import RELATIONSHIP, Resource
+from icekube.models.base import RELATIONSHIP, Resource, ResourceRef
 from icekube.models.clusterrole import ClusterRole
-from icekube.models.group import Group
 from icekube.models.role import Role
-from icekube.models.serviceaccount import ServiceAccount
-from icekube.models.user import User
 from icekube.relationships import Relationship
-from pydantic import computed_field
+from pydantic import PrivateAttr, computed_field
 
 
-def get_role(
-    role_ref: Dict[str, Any],
+def role_reference(
+    role_ref: Optional[Dict[str, Any]],
     namespace: Optional[str] = None,
-) -> Union[ClusterRole, Role]:
-    from icekube.neo4j import find_or_mock
-
-    role_ref["kind"] = role_ref.get("kind", "ClusterRole")
-    if role_ref["kind"] == "ClusterRole":
-        return find_or_mock(ClusterRole, name=role_ref["name"])
-    elif role_ref["kind"] == "Role":
-        return find_or_mock(
-            Role,
-            name=role_ref["name"],
-            namespace=role_ref.get("namespace", namespace),
+) -> ResourceRef:
+    """A reference to the role referenced by a binding."""
+    if not role_ref:
+        return ResourceRef("ClusterRole", "")
+
+    kind = role_ref.get("kind", "ClusterRole")
+    if kind == "ClusterRole":
+        return ResourceRef("ClusterRole", role_ref["name"])
+    elif kind == "Role":
+        return ResourceRef(
+            "Role", role_ref["name"], role_ref.get("namespace", namespace)
         )
     else:
-        raise Exception(f"Unknown RoleRef kind: {role_ref['kind']}")
+        raise Exception(f"Unknown RoleRef kind: {kind}")
+
+
+def mock_role(ref: ResourceRef) -> Union[ClusterRole, Role]:
+    """The role referenced by a binding, without any of its rules."""
+    if ref.kind == "Role":
+        return Role(name=ref.name, namespace=ref.namespace)
+    return ClusterRole(name=ref.name)
 
 
 def get_subjects(
     subjects: List[Dict[str, Any]],
     namespace: Optional[str] = None,
-) -> List[Union[ServiceAccount, User, Group]]:
-    results: List[Union[ServiceAccount, User, Group]] = []
+) -> List[ResourceRef]:
+    results: List[ResourceRef] = []
 
     if subjects is None:
         return results
 
     for subject in subjects:
         if subject["kind"] in ["SystemUser", "User"]:
-            results.append(User(name=subject["name"]))
+            results.append(ResourceRef("User", subject["name"]))
         elif subject["kind"] in ["SystemGroup", "Group"]:
-            results.append(Group(name=subject["name"]))
+            results.append(ResourceRef("Group", subject["name"]))
         elif subject["kind"] == "ServiceAccount":
             results.append(
-                ServiceAccount(
-                    name=subject["name"],
-                    namespace=subject.get("namespace", namespace),
+                ResourceRef(
+                    "ServiceAccount",
+                    subject["name"],
+                    subject.get("namespace", namespace),
                 ),
             )
         else:
@@ -65,18 +70,31 @@ class ClusterRoleBinding(Resource):
         "authorization.openshift.io",
     ]
 
+    _role: Optional[Union[ClusterRole, Role]] = PrivateAttr(default=None)
+
     @computed_field  # type: ignore
     @cached_property
+    def role_ref(self) -> ResourceRef:
+        return role_reference(self.data.get("roleRef"))
+
+    @property
     def role(self) -> Union[ClusterRole, Role]:
-        role_ref = self.data.get("roleRef")
-        if role_ref:
-            return get_role(role_ref)
-        else:
-            return ClusterRole(name="")
+        """The role granted, which must first be set, such as by `resolve_roles`."""
+        if self._role is None:
+            if self.role_ref.name:
+                raise ValueError(
+                    f"The role of {self} must be resolved before it is used",
+                )
+            self._role = mock_role(self.role_ref)
+        return self._role
+
+    @role.setter
+    def role(self, role: Union[ClusterRole, Role]) -> None:
+        self._role = role
 
     @computed_field  # type: ignore
     @cached_property
-    def subjects(self) -> List[Union[ServiceAccount, User, Group]]:
+    def subjects(self) -> List[ResourceRef]:
         return get_subjects(self.data.get("subjects", []))
 
     def relationships(
@@ -1,16 +1,14 @@
 from __future__ import annotations
 
-from functools import cached_property
-from itertools import product
-from pathlib import Path
-from typing import Any, Dict, List, Optional, cast
-
-import jmespath
-from icekube.models.base import RELATIONSHIP, Resource
-from icekube.models.node import Node
-from icekube.models.secret import Secret
-from icekube.models.serviceaccount import ServiceAccount
+import hashlib
+import json
+from functools import cached_property, lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple, cast
+
+from icekube.config import config
+from icekube.models.base import RELATIONSHIP, Resource, ResourceRef
 from icekube.relationships import Relationship
+from icekube.utils import PathTrie
 from pydantic import computed_field
 
 CAPABILITIES = [
@@ -58,26 +56,213 @@ CAPABILITIES = [
 ]
 
 
+# Dangerous paths to check for
+# Not all of these give direct node compromise, but will grant enough
+# permissions to maybe steal certificates to help with API server
+# as the node, or the like. More can be added with --dangerous-host-path
+DANGEROUS_HOST_PATHS = [
+    "/etc/kubernetes/admin.conf",
+    "/etc/kubernetes/kubeconfig",
+    "/etc/shadow",
+    "/proc/sys/kernel",
+    "/root/.kube/config",
+    "/root/.ssh/authorized_keys",
+    "/run/containerd/containerd.sock",
+    "/run/containerd/containerd.sock",
+    "/run/crio/crio.sock",
+    "/run/cri-dockerd.sock",
+    "/run/docker.sock",
+    "/run/dockershim.sock",
+    "/var/lib/kubelet/pods/",
+    "/var/lib/kubernetes/",
+    "/var/lib/minikube/certs/apiserver.key",
+    "/var/log",
+    "/var/run/containerd/containerd.sock",
+    "/var/run/containerd/containerd.sock",
+    "/var/run/crio/crio.sock",
+    "/var/run/cri-dockerd.sock",
+    "/var/run/docker.sock",
+    "/var/run/dockershim.sock",
+]
+
+# Fields that differ between pods created from the same template, and do not
+# affect the features extracted from a pod
+PER_POD_FIELDS = ["nodeName", "hostname"]
+
+# Each of these hold containers, with the same fields relevant to security
+CONTAINER_FIELDS = ["containers", "initContainers", "ephemeralContainers"]
+
+
+class PodFeatures(NamedTuple):
+    service_account: Optional[str]
+    capabilities: List[str]
+    privileged: bool
+    host_path_volumes: List[str]
+    dangerous_host_path: bool
+    hostPID: bool
+    hostNetwork: bool
+    mounted_secrets: List[str]
+
+
+@lru_cache(maxsize=None)
+def dangerous_path_trie(additional: Tuple[str, ...]) -> PathTrie:
+    return PathTrie(DANGEROUS_HOST_PATHS + list(additional))
+
+
+def is_dangerous_host_path(host_paths: List[str]) -> bool:
+    """Whether any of the host paths expose a dangerous location on the node."""
+    trie = dangerous_path_trie(tuple(config["dangerous_host_paths"]))
+    return any(trie.covers(x) for x in host_paths)
+
+
+def pod_features(spec: Dict[str, Any]) -> PodFeatures:
+    """Extract the security relevant features of a pod in one pass over its spec.
+
+    Containers, init containers and ephemeral containers are all considered.
+    Features of the node the pod is on are not included, so that the features
+    can be shared between pods created from the same template.
+    """
+    host_paths: List[str] = []
+    # Ordered, without duplicates
+    secrets: Dict[str, None] = {}
+
+    for volume in spec.get("volumes") or []:
+        path = (volume.get("hostPath") or {}).get("path")
+        if path is not None:
+            host_paths.append(path)
+        secret = (volume.get("secret") or {}).get("secretName")
+        if secret is not None:
+            secrets[secret] = None
+
+    capabilities: Set[str] = set()
+    privileged = False
+    for field in CONTAINER_FIELDS:
+        for container in spec.get(field) or []:
+            context = container.get("securityContext") or {}
+            privileged = privileged or bool(context.get("privileged"))
+            added = (context.get("capabilities") or {}).get("add") or []
+            capabilities.update(x.upper() for x in added)
+
+            for env in container.get("env") or []:
+                ref = (env.get("valueFrom") or {}).get("secretKeyRef") or {}
+                if ref.get("name") is not None:
+                    secrets[ref["name"]] = None
+
+    if "ALL" in capabilities:
+        capabilities.remove("ALL")
+        capabilities.update(CAPABILITIES)
+
+    return PodFeatures(
+        service_account=spec.get("serviceAccountName") or None,
+        capabilities=sorted(capabilities),
+        privileged=privileged,
+        host_path_volumes=host_paths,
+        dangerous_host_path=is_dangerous_host_path(host_paths),
+        hostPID=bool(spec.get("hostPID")),
+        hostNetwork=bool(spec.get("hostNetwork")),
+        mounted_secrets=list(secrets),
+    )
+
+
+def template_key(spec: Dict[str, Any]) -> str:
+    """A hash of a pod spec, ignoring fields that differ between replicas.
+
+    Volumes for service account tokens are given generated names, so volume
+    names are ignored, with each volume mount instead keyed on the volume it
+    mounts.
+    """
+    volumes = {
+        x.get("name"): {k: v for k, v in x.items() if k != "name"}
+        for x in spec.get("volumes") or []
+    }
+
+    template = {k: v for k, v in spec.items() if k not in PER_POD_FIELDS}
+    template["volumes"] = list(volumes.values())
+    for field in CONTAINER_FIELDS:
+        template[field] = [
+            {
+                **container,
+                "volumeMounts": [
+                    {
+                        **{k: v for k, v in x.items() if k != "name"},
+                        # Mounts of unknown volumes are left with their name
+                        "volume": volumes.get(x.get("name"), x.get("name")),
+                    }
+                    for x in container.get("volumeMounts") or []
+                ],
+            }
+            for container in spec.get(field) or []
+        ]
+
+    data = json.dumps(template, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class PodFeatureCache:
+    """Features shared between pods with the same spec, such as replicas."""
+
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self.features: Dict[Tuple[Tuple[str, ...], str], PodFeatures] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, spec: Dict[str, Any]) -> PodFeatures:
+        # Whether a host path is dangerous depends on the paths configured
+        key = (tuple(config["dangerous_host_paths"]), template_key(spec))
+        features = self.features.get(key)
+        if features is not None:
+            self.hits += 1
+            return features
+
+        self.misses += 1
+        if len(self.features) >= self.max_size:
+            self.features.clear()
+        features = self.features[key] = pod_features(spec)
+        return features
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def report(self) -> None:
+        if self.hits or self.misses:
+            print(
+                f"Pod features shared between identical pods for {self.hits} of "
+                f"{self.hits + self.misses} pods ({self.hit_rate:.0%}), "
+                f"with {len(self.features)} distinct specs",
+            )
+
+
+# The features returned are shared between pods, so must not be modified
+pod_feature_cache = PodFeatureCache()
+
+
 class Pod(Resource):
     supported_api_groups: List[str] = [""]
 
+    @cached_property
+    def features(self) -> PodFeatures:
+        return pod_feature_cache.get(self.data.get("spec") or {})
+
     @computed_field  # type: ignore
     @cached_property
-    def service_account(self) -> Optional[ServiceAccount]:
-        sa = jmespath.search("spec.serviceAccountName", self.data)
+    def service_account(self) -> Optional[ResourceRef]:
+        sa = self.features.service_account
 
         if sa:
-            return ServiceAccount(name=sa, namespace=self.namespace)
+            return ResourceRef("ServiceAccount", sa, self.namespace)
         else:
             return None
 
     @computed_field  # type: ignore
     @cached_property
-    def node(self) -> Optional[Node]:
-        node = jmespath.search("spec.nodeName", self.data)
+    def node(self) -> Optional[ResourceRef]:
+        node = self.data.get("spec", {}).get("nodeName")
 
         if node:
-            return Node(name=node)
+            return ResourceRef("Node", node)
         else:
             return None
 
@@ -85,100 +270,41 @@ class Pod(Resource):
     @cached_property
     def containers(self) -> List[Dict[str, Any]]:
         return cast(
-            List[Dict[str, Any]], jmespath.search("spec.containers[]", self.data) or []
+            List[Dict[str, Any]], self.data.get("spec", {}).get("containers") or []
         )
 
     @computed_field  # type: ignore
     @cached_property
     def capabilities(self) -> List[str]:
-        capabilities = set()
-
-        for container in self.containers:
-            addl = jmespath.search("securityContext.capabilities.add", container) or []
-            addl = [x.upper() for x in addl]
-            add = set(addl)
-
-            if "ALL" in add:
-                add.remove("ALL")
-                add.update(set(CAPABILITIES))
-
-            capabilities.update(add)
-
-        return list(capabilities)
+        return self.features.capabilities
 
     @computed_field  # type: ignore
     @cached_property
     def privileged(self) -> bool:
-        privileged = (
-            jmespath.search("spec.containers[].securityContext.privileged", self.data)
-            or []
-        )
-        return any(privileged)
+        return self.features.privileged
 
     @computed_field  # type: ignore
     @cached_property
     def host_path_volumes(self) -> List[str]:
-        return jmespath.search("spec.volumes[].hostPath.path", self.data) or []
+        return self.features.host_path_volumes
 
     @computed_field  # type: ignore
     @cached_property
     def hostPID(self) -> bool:
-        return jmespath.search("spec.hostPID", self.data) or False
+        return self.features.hostPID
 
     @computed_field  # type: ignore
     @cached_property
     def hostNetwork(self) -> bool:
-        return jmespath.search("spec.hostNetwork", self.data) or False
+        return self.features.hostNetwork
 
     @property
     def dangerous_host_path(self) -> bool:
-        # Dangerous paths to check for
-        # Not all of these give direct node compromise, but will grant enough
-        # permissions to maybe steal certificates to help with API server
-        # as the node, or the like
-        dangerous_paths = [
-            "/etc/kubernetes/admin.conf",
-            "/etc/kubernetes/kubeconfig",
-            "/etc/shadow",
-            "/proc/sys/kernel",
-            "/root/.kube/config",
-            "/root/.ssh/authorized_keys",
-            "/run/containerd/containerd.sock",
-            "/run/containerd/containerd.sock",
-            "/run/crio/crio.sock",
-            "/run/cri-dockerd.sock",
-            "/run/docker.sock",
-            "/run/dockershim.sock",
-            "/var/lib/kubelet/pods/",
-            "/var/lib/kubernetes/",
-            "/var/lib/minikube/certs/apiserver.key",
-            "/var/log",
-            "/var/run/containerd/containerd.sock",
-            "/var/run/containerd/containerd.sock",
-            "/var/run/crio/crio.sock",
-            "/var/run/cri-dockerd.sock",
-            "/var/run/docker.sock",
-            "/var/run/dockershim.sock",
-        ]
-        for volume, test_path in product(self.host_path_volumes, dangerous_paths):
-            try:
-                Path(test_path).relative_to(Path(volume))
-                return True
-            except ValueError:
-                pass
-        return False
+        return self.features.dangerous_host_path
 
     @property
     def mounted_secrets(self) -> List[str]:
-        secrets = jmespath.search("spec.volumes[].secret.secretName", self.data) or []
-        secrets += (
-            jmespath.search(
-                "spec.containers[].env[].valueFrom.secretKeyRef.name", self.data
-            )
-            or []
-        )
-
-        return secrets
+        return self.features.mounted_secrets
 
     @property
     def db_labels(self) -> Dict[str, Any]:
@@ -207,10 +333,7 @@ class Pod(Resource):
                 (
                     self,
                     Relationship.MOUNTS_SECRET,
-                    Secret(
-                        namespace=cast(str, self.namespace),
-                        name=secret,
-                    ),
+                    ResourceRef("Secret", secret, self.namespace),
                 ),
             ]
 
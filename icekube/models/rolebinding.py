@@ -1,17 +1,18 @@
 from __future__ import annotations
 
 from functools import cached_property
-from typing import List, Union
+from typing import List, Optional, Union
 
-from icekube.models.base import RELATIONSHIP, Resource
+from icekube.models.base import RELATIONSHIP, Resource, ResourceRef
 from icekube.models.clusterrole import ClusterRole
-from icekube.models.clusterrolebinding import get_role, get_subjects
-from icekube.models.group import Group
+from icekube.models.clusterrolebinding import (
+    get_subjects,
+    mock_role,
+    role_reference,
+)
 from icekube.models.role import Role
-from icekube.models.serviceaccount import ServiceAccount
-from icekube.models.user import User
 from icekube.relationships import Relationship
-from pydantic import computed_field
+from pydantic import PrivateAttr, computed_field
 
 
 class RoleBinding(Resource):
@@ -20,19 +21,31 @@ class RoleBinding(Resource):
         "authorization.openshift.io",
     ]
 
+    _role: Optional[Union[ClusterRole, Role]] = PrivateAttr(default=None)
+
     @computed_field  # type: ignore
     @cached_property
+    def role_ref(self) -> ResourceRef:
+        return role_reference(self.data.get("roleRef"), self.namespace)
+
+    @property
     def role(self) -> Union[ClusterRole, Role]:
-        role_ref = self.data.get("roleRef")
+        """The role granted, which must first be set, such as by `resolve_roles`."""
+        if self._role is None:
+            if self.role_ref.name:
+                raise ValueError(
+                    f"The role of {self} must be resolved before it is used",
+                )
+            self._role = mock_role(self.role_ref)
+        return self._role
 
-        if role_ref:
-            return get_role(role_ref, self.namespace)
-        else:
-            return ClusterRole(name="")
+    @role.setter
+    def role(self, role: Union[ClusterRole, Role]) -> None:
+        self._role = role
 
     @computed_field  # type: ignore
     @cached_property
-    def subjects(self) -> List[Union[ServiceAccount, User, Group]]:
+    def subjects(self) -> List[ResourceRef]:
         return get_subjects(self.data.get("subjects", []), self.namespace)
 
     def relationships(
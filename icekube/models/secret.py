@@ -4,7 +4,7 @@ import json
 from functools import cached_property
 from typing import Any, Dict, List, Optional, cast
 
-from icekube.models.base import RELATIONSHIP, Resource
+from icekube.models.base import RELATIONSHIP, Resource, ResourceRef
 from icekube.relationships import Relationship
 from pydantic import computed_field, field_validator
 
@@ -52,14 +52,9 @@ class Secret(Resource):
         relationships = super().relationships()
 
         if self.secret_type == "kubernetes.io/service-account-token":
-            from icekube.models.serviceaccount import ServiceAccount
-
             sa = self.annotations.get("kubernetes.io/service-account.name")
             if sa:
-                account = ServiceAccount(
-                    name=sa,
-                    namespace=cast(str, self.namespace),
-                )
+                account = ResourceRef("ServiceAccount", sa, self.namespace)
                 relationships.append(
                     (
                         self,
@@ -1,12 +1,9 @@
 from __future__ import annotations
 
 from functools import cached_property
-from typing import List, Union
+from typing import List
 
-from icekube.models.base import RELATIONSHIP, Resource
-from icekube.models.group import Group
-from icekube.models.serviceaccount import ServiceAccount
-from icekube.models.user import User
+from icekube.models.base import RELATIONSHIP, Resource, ResourceRef
 from pydantic import computed_field
 
 
@@ -16,25 +13,25 @@ class SecurityContextConstraints(Resource):
 
     @computed_field  # type: ignore
     @cached_property
-    def users(self) -> List[Union[User, ServiceAccount]]:
-        users: List[Union[User, ServiceAccount]] = []
+    def users(self) -> List[ResourceRef]:
+        users: List[ResourceRef] = []
         raw_users = self.data.get("users", [])
 
         for user in raw_users:
             if user.startswith("system:serviceaccount:"):
                 ns, name = user.split(":")[2:]
-                users.append(ServiceAccount(name=name, namespace=ns))
+                users.append(ResourceRef("ServiceAccount", name, ns))
             else:
-                users.append(User(name=user))
+                users.append(ResourceRef("User", user))
 
         return users
 
     @computed_field  # type: ignore
     @cached_property
-    def groups(self) -> List[Group]:
+    def groups(self) -> List[ResourceRef]:
         raw_groups = self.data.get("groups", [])
 
-        return [Group(name=x) for x in raw_groups]
+        return [ResourceRef("Group", x) for x in raw_groups]
 
     def relationships(self, initial: bool = True) -> List[RELATIONSHIP]:
         relationships = super().relationships()
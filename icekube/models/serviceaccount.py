@@ -3,8 +3,7 @@ from __future__ import annotations
 from functools import cached_property
 from typing import List
 
-from icekube.models.base import RELATIONSHIP, Resource
-from icekube.models.secret import Secret
+from icekube.models.base import RELATIONSHIP, Resource, ResourceRef
 from icekube.relationships import Relationship
 from pydantic import computed_field
 
@@ -14,13 +13,13 @@ class ServiceAccount(Resource):
 
     @computed_field  # type: ignore
     @cached_property
-    def secrets(self) -> List[Secret]:
+    def secrets(self) -> List[ResourceRef]:
         secrets = []
         raw_secrets = self.data.get("secrets") or []
 
         for secret in raw_secrets:
             secrets.append(
-                Secret(name=secret.get("name", ""), namespace=self.namespace),
+                ResourceRef("Secret", secret.get("name", ""), self.namespace),
             )
 
         return secrets
@@ -1,11 +1,30 @@
 from __future__ import annotations
 
 import logging
-from typing import Any, Dict, Generator, List, Optional, Tuple, Type, TypeVar
-
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import TracebackType
+from typing import (
+    Any,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
+
+from icekube.blobstore import raw_store, store_raw
 from icekube.config import config
 from icekube.models import Resource
-from neo4j import BoltDriver, GraphDatabase
+from icekube.models.base import ResourceRef
+from icekube.models.clusterrolebinding import ClusterRoleBinding, mock_role
+from icekube.models.rolebinding import RoleBinding
+from icekube.profiling import run_query, write_transaction
+from neo4j import BoltDriver, GraphDatabase, Record, Session, Transaction
 from neo4j.io import ServiceUnavailable
 
 T = TypeVar("T")
@@ -38,7 +57,133 @@ def init_connection(
     )
     encrypted = neo4j_config.get("encrypted", encrypted)
 
-    return GraphDatabase.driver(uri, auth=auth, encrypted=encrypted)
+    return GraphDatabase.driver(
+        uri,
+        auth=auth,
+        encrypted=encrypted,
+        max_connection_pool_size=neo4j_config.get("pool_size", 100),
+        max_transaction_retry_time=neo4j_config.get("retry_time", 30.0),
+        initial_retry_delay=neo4j_config.get("retry_delay", 1.0),
+    )
+
+
+Statement = Tuple[str, Dict[str, Any], Optional[str], "Future[List[Record]]"]
+
+
+def run_statements(tx: Transaction, statements: List[Statement]) -> List[List[Record]]:
+    return [
+        run_query(tx, cmd, parameters, name) for cmd, parameters, name, _ in statements
+    ]
+
+
+def write(
+    cmd: str,
+    parameters: Optional[Dict[str, Any]] = None,
+    name: Optional[str] = None,
+) -> List[Record]:
+    """Run a single write query in a managed transaction.
+
+    The transaction is retried with backoff on transient errors, such as
+    deadlocks or leader switches, for up to the configured retry time.
+    """
+    with get_driver().session() as session:
+        return write_transaction(session, run_query, cmd, parameters, name)
+
+
+class Writer:
+    """Runs write queries concurrently over a pool of long-lived sessions.
+
+    Queries are grouped into batches, each of which is written in a single
+    managed transaction that is retried with backoff on transient errors.
+    Batches are handed to a fixed number of worker threads, each keeping a
+    single session open until the writer is closed. The number of queued batches
+    is bounded so that producers cannot run too far ahead of neo4j, and the first
+    failure is raised to the producer on its next call or on close.
+
+    A writer should only be fed by a single thread.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        batch_size: Optional[int] = None,
+    ) -> None:
+        self.workers = workers or config["neo4j"]["writers"]
+        self.batch_size = batch_size or config["neo4j"]["batch_size"]
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.sessions: List[Session] = []
+        self.slots = threading.BoundedSemaphore(self.workers * 4)
+        self.pending: List[Statement] = []
+        self.error: Optional[BaseException] = None
+
+    def __enter__(self) -> Writer:
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def session(self) -> Session:
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = get_driver().session()
+            self.local.session = session
+            with self.lock:
+                self.sessions.append(session)
+        return session
+
+    def execute(self, statements: List[Statement]) -> None:
+        try:
+            results = write_transaction(self.session(), run_statements, statements)
+        except BaseException as e:
+            self.error = self.error or e
+            for *_, future in statements:
+                future.set_exception(e)
+        else:
+            for (*_, future), result in zip(statements, results):
+                future.set_result(result)
+        finally:
+            self.slots.release()
+
+    def run(
+        self,
+        cmd: str,
+        parameters: Optional[Dict[str, Any]] = None,
+        name: Optional[str] = None,
+    ) -> Future[List[Record]]:
+        if self.error:
+            raise self.error
+
+        future: Future[List[Record]] = Future()
+        self.pending.append((cmd, parameters or {}, name, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+        return future
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+
+        statements, self.pending = self.pending, []
+        self.slots.acquire()
+        self.executor.submit(self.execute, statements)
+
+    def close(self) -> None:
+        self.flush()
+        self.executor.shutdown(wait=True)
+        for session in self.sessions:
+            session.close()
+        self.sessions = []
+
+        if self.error:
+            raise self.error
 
 
 def create_index(kind: str, namespace: bool) -> None:
@@ -54,22 +199,24 @@ def create_index(kind: str, namespace: bool) -> None:
 
 
 def get(
-    resource: Resource,
+    resource: Union[Resource, ResourceRef],
     identifier: str = "",
     prefix: str = "",
 ) -> Tuple[str, Dict[str, str]]:
-    kwargs: Dict[str, str] = {}
     labels: List[str] = []
     identifier = identifier or prefix
 
     if prefix:
         prefix += "_"
 
+    kwargs: Dict[str, str] = {f"{prefix}identity": resource.identity}
+
     for key, value in resource.unique_identifiers.items():
         labels.append(f"{key}: ${prefix}{key}")
         kwargs[f"{prefix}{key}"] = value
 
-    cmd = f"MERGE ({identifier}:{resource.kind} {{ {', '.join(labels)} }}) "
+    cmd = f"MERGE ({identifier}:{resource.kind} {{ identity: ${prefix}identity }}) "
+    cmd += f"ON CREATE SET {identifier} += {{ {', '.join(labels)} }} "
 
     return cmd, kwargs
 
@@ -82,7 +229,7 @@ def create(resource: Resource, prefix: str = "") -> Tuple[str, Dict[str, Any]]:
     if prefix:
         prefix += "_"
 
-    for key, value in resource.db_labels.items():
+    for key, value in store_raw(resource.db_labels).items():
         labels.append(f"{key}: ${prefix}{key}")
         kwargs[f"{prefix}{key}"] = value
 
@@ -103,7 +250,7 @@ def find(
         cmd = f"MATCH (x:{resource.__name__} {{ {', '.join(labels)} }}) "
 
     if raw:
-        cmd += "WHERE EXISTS (x.raw) "
+        cmd += "WHERE EXISTS (x.raw) OR EXISTS (x.raw_ref) "
 
     cmd += "RETURN x"
 
@@ -129,8 +276,68 @@ def find(
             yield res
 
 
+def missing_raw_store() -> bool:
+    """Whether nodes only hold a `raw_ref`, but no raw store is configured.
+
+    The payloads of these nodes cannot be read, such as to generate their
+    relationships.
+    """
+    if raw_store() is not None:
+        return False
+
+    cmd = "MATCH (n) WHERE EXISTS (n.raw_ref) AND NOT EXISTS (n.raw) RETURN 1 LIMIT 1"
+    try:
+        with get_driver().session() as session:
+            return session.run(cmd).single() is not None
+    except ServiceUnavailable:
+        return False
+
+
 def find_or_mock(resource: Type[T], **kwargs: str) -> T:
     try:
         return next(find(resource, **kwargs))  # type: ignore
     except (StopIteration, IndexError, ServiceUnavailable):
         return resource(**kwargs)
+
+
+def resolve_roles(resources: Iterable[Resource]) -> None:
+    """Set the roles of any bindings, loading them all with a single query.
+
+    Roles that cannot be found are mocked, without any rules.
+    """
+    bindings = [
+        x for x in resources if isinstance(x, (ClusterRoleBinding, RoleBinding))
+    ]
+    if not bindings:
+        return
+
+    refs = [x.role_ref for x in bindings]
+    cmd = (
+        "UNWIND $cluster_roles AS name "
+        "MATCH (n:ClusterRole { name: name }) RETURN n "
+        "UNION ALL "
+        "UNWIND $roles AS role "
+        "MATCH (n:Role { namespace: role[0], name: role[1] }) RETURN n"
+    )
+    kwargs = {
+        "cluster_roles": sorted({x.name for x in refs if x.kind == "ClusterRole"}),
+        "roles": [
+            list(x)
+            for x in sorted({(x.namespace, x.name) for x in refs if x.kind == "Role"})
+        ],
+    }
+
+    found: Dict[Tuple[str, Optional[str], str], Resource] = {}
+    try:
+        with get_driver().session() as session:
+            logger.debug(f"Starting neo4j query: {cmd}, {kwargs}")
+            for (node,) in session.run(cmd, kwargs):
+                props = node._properties
+                key = (props["kind"], props.get("namespace"), props["name"])
+                found.setdefault(key, Resource(**props))
+    except ServiceUnavailable:
+        logger.warning("Unable to load roles from neo4j, mocking them instead")
+
+    for binding, ref in zip(bindings, refs):
+        role = found.get((ref.kind, ref.namespace, ref.name))
+        binding.role = role if role is not None else mock_role(ref)  # type: ignore
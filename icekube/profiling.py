@@ -0,0 +1,199 @@
+from __future__ import annotations
+
+import json
+import logging
+import time
+from threading import Lock, local
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
+
+from icekube.config import config
+from neo4j import Record, ResultSummary, Session, Transaction
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+MAX_PARAMETER_LENGTH = 200
+
+T = TypeVar("T")
+
+# The arguments to QueryProfiler.record for a query
+Observation = Tuple[str, str, Dict[str, Any], float, int, ResultSummary]
+
+
+class QueryStats(BaseModel):
+    name: str
+    query: str
+    calls: int = 0
+    total_time: float = 0
+    max_time: float = 0
+    rows: int = 0
+    nodes_created: int = 0
+    relationships_created: int = 0
+    properties_set: int = 0
+    db_hits: int = 0
+    slowest_parameters: Dict[str, Any] = {}
+    plan: Optional[Dict[str, Any]] = None
+
+
+def summarise_parameters(parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """Shorten long parameters, such as raw resources, for logs and reports."""
+    summary = {}
+    for key, value in parameters.items():
+        if isinstance(value, str) and len(value) > MAX_PARAMETER_LENGTH:
+            value = value[:MAX_PARAMETER_LENGTH] + "..."
+        elif isinstance(value, list) and len(value) > MAX_PARAMETER_LENGTH:
+            value = f"<list of {len(value)} items>"
+        summary[key] = value
+    return summary
+
+
+def simplify_plan(plan: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "operator": plan.get("operatorType"),
+        "db_hits": plan.get("dbHits", 0),
+        "rows": plan.get("rows", 0),
+        "children": [simplify_plan(x) for x in plan.get("children", [])],
+    }
+
+
+def total_db_hits(plan: Dict[str, Any]) -> int:
+    return int(plan.get("dbHits", 0)) + sum(
+        total_db_hits(x) for x in plan.get("children", [])
+    )
+
+
+class QueryProfiler:
+    """Collects timings and counters for each distinct query that is run."""
+
+    def __init__(self) -> None:
+        self.stats: Dict[str, QueryStats] = {}
+        self.lock = Lock()
+        # Queries run by the current attempt of a transaction, by thread
+        self.local = local()
+
+    def observe(self, *observation: Any) -> None:
+        """Record a query, or hold it until its transaction commits."""
+        attempt: Optional[List[Observation]] = getattr(self.local, "attempt", None)
+        if attempt is None:
+            self.record(*observation)
+        else:
+            attempt.append(cast(Observation, observation))
+
+    def record(
+        self,
+        name: str,
+        query: str,
+        parameters: Dict[str, Any],
+        elapsed: float,
+        rows: int,
+        summary: ResultSummary,
+    ) -> None:
+        counters = summary.counters
+        plan = summary.profile
+
+        with self.lock:
+            stats = self.stats.setdefault(name, QueryStats(name=name, query=query))
+            stats.calls += 1
+            stats.total_time += elapsed
+            stats.rows += rows
+            stats.nodes_created += counters.nodes_created
+            stats.relationships_created += counters.relationships_created
+            stats.properties_set += counters.properties_set
+            if plan:
+                stats.db_hits += total_db_hits(plan)
+
+            if elapsed >= stats.max_time:
+                stats.max_time = elapsed
+                stats.slowest_parameters = summarise_parameters(parameters)
+                if plan:
+                    stats.plan = simplify_plan(plan)
+
+        threshold = config["profile"]["slow_query_threshold"]
+        if elapsed >= threshold:
+            logger.warning(
+                f"Slow query ({elapsed:.2f}s) {name}: {query} "
+                f"{summarise_parameters(parameters)}",
+            )
+
+    def report(self) -> Dict[str, Any]:
+        queries = sorted(self.stats.values(), key=lambda x: -x.total_time)
+        return {
+            "total_time": sum(x.total_time for x in queries),
+            "queries": [x.model_dump() for x in queries],
+        }
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as fs:
+            fs.write(json.dumps(self.report(), indent=2))
+
+
+profiler = QueryProfiler()
+
+
+def run_query(
+    runner: Union[Session, Transaction],
+    cmd: str,
+    parameters: Optional[Dict[str, Any]] = None,
+    name: Optional[str] = None,
+) -> List[Record]:
+    """Run a query, recording its statistics when profiling is enabled.
+
+    The result is always consumed before returning, so that the timings include
+    the time taken for neo4j to finish executing the query.
+    """
+    parameters = parameters or {}
+
+    if not config["profile"]["enabled"]:
+        return list(runner.run(cmd, parameters))
+
+    start = time.perf_counter()
+    if config["profile"]["plan"]:
+        result = runner.run(f"PROFILE {cmd}", parameters)
+    else:
+        result = runner.run(cmd, parameters)
+    records = list(result)
+    summary = result.consume()
+    elapsed = time.perf_counter() - start
+
+    profiler.observe(name or cmd, cmd, parameters, elapsed, len(records), summary)
+
+    return records
+
+
+def write_transaction(
+    session: Session,
+    work: Callable[..., T],
+    *args: Any,
+) -> T:
+    """Run work in a managed write transaction, which is retried on failure.
+
+    When profiling, only the queries of the attempt that commits are recorded,
+    so that retried queries are not counted once for every attempt.
+    """
+    if not config["profile"]["enabled"]:
+        return cast(T, session.write_transaction(work, *args))
+
+    def attempt(tx: Transaction, *args: Any) -> T:
+        # Queries of earlier, failed attempts are discarded
+        profiler.local.attempt = []
+        return work(tx, *args)
+
+    try:
+        result = cast(T, session.write_transaction(attempt, *args))
+        observations = profiler.local.attempt
+    finally:
+        profiler.local.attempt = None
+
+    for x in observations:
+        profiler.record(*x)
+    return result
@@ -0,0 +1,131 @@
+"""Evaluating query endpoints of relationships against nodes held in memory.
+
+Models describe some relationship endpoints as a cypher query rather than a
+resource, generated by `generate_query` in the form `MATCH ({prefix}) WHERE`
+followed by regular expression matches on node properties. These are parsed so
+that the nodes they match can be found without a round trip to neo4j.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from icekube.models.base import QUERY_RESOURCE
+
+# Properties that query endpoints filter on, kept for every node
+QUERY_PROPERTIES = ["apiVersion", "kind", "plural", "namespace", "name"]
+# Properties that are usually matched literally, used to narrow down candidates
+BUCKET_PROPERTIES = ["kind", "plural"]
+
+WHERE_CLAUSE = re.compile(r"^\s*MATCH \((?:\{prefix\}|\w+)\) WHERE(.*)$", re.DOTALL)
+REGEX_ATOM = re.compile(r"^(?:\{prefix\}|\w+)\.(\w+) =~ \$\{prefix\}_(\w+)$")
+EQUALS_ATOM = re.compile(r"^(NOT )?(?:\{prefix\}|\w+)\.(\w+) = '([^']*)'$")
+
+Node = Dict[str, Optional[str]]
+Predicate = Callable[[Node], bool]
+
+
+def parse_atom(atom: str, parameters: Dict[str, str]) -> Predicate:
+    match = REGEX_ATOM.match(atom)
+    if match:
+        prop, parameter = match.groups()
+        pattern = re.compile(parameters[parameter])
+
+        def regex(node: Node) -> bool:
+            value = node.get(prop)
+            return value is not None and pattern.fullmatch(value) is not None
+
+        return regex
+
+    match = EQUALS_ATOM.match(atom)
+    if match:
+        negate, prop, literal = match.groups()
+
+        def equals(node: Node) -> bool:
+            value = node.get(prop)
+            if value is None:
+                # Comparisons against null are never true in cypher
+                return False
+            return (value == literal) != bool(negate)
+
+        return equals
+
+    raise ValueError(f"Unsupported query condition: {atom}")
+
+
+def parse_query(
+    query: QUERY_RESOURCE,
+) -> Tuple[List[List[Predicate]], Dict[str, str]]:
+    """Parse a query endpoint into AND-ed groups of OR-ed conditions.
+
+    Also returns the literal values any properties in BUCKET_PROPERTIES must
+    equal, so that candidates can be looked up directly.
+    """
+    cmd, parameters = query
+    match = WHERE_CLAUSE.match(cmd)
+    if not match:
+        raise ValueError(f"Unsupported query: {cmd}")
+
+    clauses: List[List[Predicate]] = []
+    literals: Dict[str, str] = {}
+    for clause in match.group(1).split(" AND "):
+        clause = clause.strip()
+        if clause.startswith("(") and clause.endswith(")"):
+            clause = clause[1:-1]
+        atoms = [x.strip() for x in clause.split(" OR ")]
+        clauses.append([parse_atom(x, parameters) for x in atoms])
+
+        regex = REGEX_ATOM.match(atoms[0])
+        if len(atoms) == 1 and regex and regex.group(1) in BUCKET_PROPERTIES:
+            value = parameters[regex.group(2)]
+            if re.escape(value) == value:
+                literals[regex.group(1)] = value
+
+    return clauses, literals
+
+
+class NodeIndex:
+    """Properties of nodes by identity, for resolving query endpoints."""
+
+    def __init__(self) -> None:
+        self.nodes: Dict[str, Node] = {}
+        self.buckets: Dict[str, Dict[str, List[str]]] = {
+            x: {} for x in BUCKET_PROPERTIES
+        }
+        self.resolved: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[str]] = {}
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def __contains__(self, identity: str) -> bool:
+        return identity in self.nodes
+
+    def add(self, identity: str, properties: Dict[str, Any]) -> None:
+        node = {x: properties.get(x) for x in QUERY_PROPERTIES}
+        self.nodes[identity] = node
+        for prop, bucket in self.buckets.items():
+            value = node[prop]
+            if value is not None:
+                bucket.setdefault(value, []).append(identity)
+        self.resolved = {}
+
+    def resolve(self, query: QUERY_RESOURCE) -> List[str]:
+        """Identities of the nodes a query endpoint matches."""
+        key = (query[0], tuple(sorted(query[1].items())))
+        if key in self.resolved:
+            return self.resolved[key]
+
+        clauses, literals = parse_query(query)
+
+        candidates: Iterable[str] = self.nodes
+        for prop, value in literals.items():
+            candidates = self.buckets[prop].get(value, [])
+            break
+
+        self.resolved[key] = [
+            identity
+            for identity in candidates
+            if all(any(x(self.nodes[identity]) for x in c) for c in clauses)
+        ]
+        return self.resolved[key]
@@ -0,0 +1,37 @@
+from typing import Dict, List, Tuple
+
+# Kinds that are treated as starting points when listing who can reach a target
+PRINCIPAL_KINDS = ["ServiceAccount", "Pod", "User", "Group"]
+
+# Crown-jewel targets that reachability is precomputed for. Each query binds the
+# target nodes to `target`, and the key is used to name the properties stored on
+# every node that can reach one of them.
+reachability_targets: Dict[str, str] = {
+    # Cluster role bindings to cluster-admin, the destination of IS_CLUSTER_ADMIN
+    "cluster_admin": """
+        MATCH (target:ClusterRoleBinding)-[:GRANTS_PERMISSION]->(:ClusterRole {
+          name: 'cluster-admin'
+        })
+        """,
+    # Any node within the cluster
+    "node": "MATCH (target:Node)",
+    # Members of system:masters bypass RBAC entirely
+    "system_masters": "MATCH (target:Group {name: 'system:masters'})",
+}
+
+
+def reachability_properties(target: str) -> Tuple[str, str, str]:
+    """Node properties holding the hop count, next hop and relationship used."""
+    return (
+        f"reach_{target}_hops",
+        f"reach_{target}_next",
+        f"reach_{target}_via",
+    )
+
+
+def all_reachability_properties() -> List[str]:
+    return [
+        prop
+        for target in reachability_targets
+        for prop in reachability_properties(target)
+    ]
@@ -0,0 +1,496 @@
+"""Reading and writing the files saved by `icekube download`.
+
+Each resource type is saved to its own file, `<plural>.<group>.json` holding a
+JSON array or `<plural>.<group>.ndjson` holding one object per line, optionally
+compressed with gzip (`.gz`) or zstd (`.zst`). zstd requires the `zstandard`
+package, which is not installed by default. Resources are written as they are
+received, so only the resource currently being written is held in memory, and
+are loaded in parallel across processes while keeping their original text.
+
+Alternatively, everything can be saved to a single indexed `snapshot.pack` file,
+which is memory mapped on load so only the records needed are read.
+"""
+
+from __future__ import annotations
+
+import gzip
+import io
+import json
+import mmap
+import multiprocessing
+import struct
+from itertools import groupby
+from pathlib import Path
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+
+from icekube.config import Config, config
+from icekube.models import APIResource, Resource
+from icekube.models.base import clear_resource_refs
+from icekube.trimming import trim_report
+from tqdm import tqdm
+
+FORMATS = ["json", "ndjson", "pack"]
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+
+PACK_NAME = "snapshot.pack"
+PACK_MAGIC = b"ICEKUBE\x01"
+# Offset and length of the index, followed by the magic again
+PACK_TRAILER = struct.Struct("<QQ8s")
+
+# Characters read at a time when parsing JSON arrays
+READ_SIZE = 1 << 20
+# Bytes of an uncompressed NDJSON file parsed by each process at a time
+TASK_SIZE = 16 << 20
+
+# A file along with the range of bytes to read from it
+SnapshotTask = Tuple[str, int, Optional[int]]
+
+
+def open_compressed(path: Path, mode: str) -> IO[str]:
+    """Open a text file, compressing or decompressing based on its suffix."""
+    if path.suffix == ".gz":
+        return cast(IO[str], gzip.open(path, f"{mode}t", encoding="utf-8"))
+    elif path.suffix == ".zst":
+        import zstandard
+
+        fs = open(path, f"{mode}b")
+        if mode == "w":
+            stream: Any = zstandard.ZstdCompressor().stream_writer(fs)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(fs)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    else:
+        return open(path, mode, encoding="utf-8")
+
+
+class ResourceStream:
+    """Writes items of a single resource type to a file as they are received."""
+
+    def __init__(self, path: Path, fmt: str):
+        self.fs = open_compressed(path, "w")
+        self.fmt = fmt
+        self.count = 0
+
+        if self.fmt == "json":
+            self.fs.write("[")
+
+    def write(self, item: str) -> None:
+        if self.fmt == "json":
+            self.fs.write(",\n" if self.count else "\n")
+            self.fs.write(item)
+        else:
+            self.fs.write(item)
+            self.fs.write("\n")
+        self.count += 1
+
+    def close(self) -> None:
+        if self.fmt == "json":
+            self.fs.write("\n]\n")
+        self.fs.close()
+
+
+class SnapshotWriter:
+    """Streams resources into one file per resource type within a directory."""
+
+    def __init__(
+        self,
+        path: Path,
+        fmt: str = "json",
+        compression: Optional[str] = None,
+    ):
+        if fmt not in FORMATS or fmt == "pack":
+            raise ValueError(f"Unknown snapshot format: {fmt}")
+        if compression is not None and compression not in COMPRESSION_SUFFIXES:
+            raise ValueError(f"Unknown compression: {compression}")
+
+        self.path = path
+        self.fmt = fmt
+        self.suffix = f".{fmt}" + COMPRESSION_SUFFIXES.get(compression or "", "")
+        self.streams: Dict[str, ResourceStream] = {}
+
+    def __enter__(self) -> SnapshotWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def write(self, resource: Resource) -> None:
+        if not resource.raw:
+            return
+
+        resource_type = resource.resource_definition_name
+        if resource_type not in self.streams:
+            self.streams[resource_type] = ResourceStream(
+                self.path / f"{resource_type}{self.suffix}",
+                self.fmt,
+            )
+        self.streams[resource_type].write(resource.raw)
+
+    def close(self) -> None:
+        for stream in self.streams.values():
+            stream.close()
+        self.streams = {}
+
+
+class PackEntry(NamedTuple):
+    offset: int
+    length: int
+    plural: str
+    apiVersion: str
+    kind: str
+    namespace: Optional[str]
+    name: str
+
+
+class PackWriter:
+    """Writes resources as records within a single file, followed by an index.
+
+    The file starts with PACK_MAGIC, followed by the raw JSON of each resource
+    back to back. After the records is a JSON index of PackEntry lists, and the
+    file ends with a trailer holding the offset and length of the index.
+    """
+
+    def __init__(self, path: Path):
+        self.fs = open(path, "wb")
+        self.fs.write(PACK_MAGIC)
+        self.index: List[PackEntry] = []
+
+    def __enter__(self) -> PackWriter:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def write(self, resource: Resource) -> None:
+        if not resource.raw:
+            return
+
+        record = resource.raw.encode("utf-8")
+        self.index.append(
+            PackEntry(
+                offset=self.fs.tell(),
+                length=len(record),
+                plural=resource.plural,
+                apiVersion=resource.apiVersion,
+                kind=resource.kind,
+                namespace=resource.namespace,
+                name=resource.name,
+            ),
+        )
+        self.fs.write(record)
+
+    def close(self) -> None:
+        offset = self.fs.tell()
+        index = json.dumps(self.index).encode("utf-8")
+        self.fs.write(index)
+        self.fs.write(PACK_TRAILER.pack(offset, len(index), PACK_MAGIC))
+        self.fs.close()
+
+
+class PackedSnapshot:
+    """A memory mapped pack file, reading records only when they are needed."""
+
+    def __init__(self, path: Path):
+        self.fs = open(path, "rb")
+        self.data = mmap.mmap(self.fs.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset, length, magic = PACK_TRAILER.unpack_from(
+            self.data,
+            len(self.data) - PACK_TRAILER.size,
+        )
+        if self.data[: len(PACK_MAGIC)] != PACK_MAGIC or magic != PACK_MAGIC:
+            raise ValueError(f"{path} is not an IceKube pack file")
+
+        self.index = [
+            PackEntry(*x) for x in json.loads(self.data[offset : offset + length])
+        ]
+        self.lookup: Dict[Tuple[str, str, Optional[str], str], PackEntry] = {
+            (x.apiVersion, x.kind, x.namespace, x.name): x for x in self.index
+        }
+
+    def __enter__(self) -> PackedSnapshot:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def select(
+        self,
+        kinds: Optional[List[str]] = None,
+        namespaces: Optional[List[str]] = None,
+    ) -> Iterator[PackEntry]:
+        for entry in self.index:
+            if kinds and entry.kind not in kinds:
+                continue
+            if namespaces and entry.namespace not in namespaces:
+                continue
+            yield entry
+
+    def raw(self, entry: PackEntry) -> str:
+        return self.data[entry.offset : entry.offset + entry.length].decode("utf-8")
+
+    def resource(self, entry: PackEntry) -> Resource:
+        return Resource.trusted(
+            apiVersion=entry.apiVersion,
+            kind=entry.kind,
+            name=entry.name,
+            namespace=entry.namespace,
+            plural=entry.plural,
+            raw=self.raw(entry),
+        )
+
+    def get(
+        self,
+        apiVersion: str,
+        kind: str,
+        name: str,
+        namespace: Optional[str] = None,
+    ) -> Optional[Resource]:
+        entry = self.lookup.get((apiVersion, kind, namespace, name))
+        return self.resource(entry) if entry else None
+
+    def close(self) -> None:
+        self.data.close()
+        self.fs.close()
+
+
+def open_snapshot_writer(
+    path: Path,
+    fmt: str = "json",
+    compression: Optional[str] = None,
+) -> Union[SnapshotWriter, PackWriter]:
+    if fmt == "pack":
+        if compression:
+            raise ValueError("Pack files cannot be compressed")
+        return PackWriter(path / PACK_NAME)
+    return SnapshotWriter(path, fmt, compression)
+
+
+def snapshot_files(path: Path) -> List[Path]:
+    return sorted(
+        x
+        for x in path.glob("*")
+        if x.is_file() and x.name not in ["_metadata.json", PACK_NAME]
+    )
+
+
+def iter_json_items(fs: IO[str]) -> Iterator[Tuple[Dict[str, Any], str]]:
+    """Incrementally parse the items of a JSON array, along with their text.
+
+    The text of each item is kept as it was in the file, so that it does not
+    need to be serialised again. A `kubectl get -o json` list is parsed whole.
+    """
+    decoder = json.JSONDecoder()
+    buffer = fs.read(READ_SIZE)
+    pos = 0
+    eof = not buffer
+
+    while pos < len(buffer) and buffer[pos].isspace():
+        pos += 1
+    if buffer[pos : pos + 1] == "{":
+        # If downloaded via kubectl get -A
+        for item in json.loads(buffer[pos:] + fs.read())["items"]:
+            yield item, json.dumps(item, default=str)
+        return
+    elif buffer[pos : pos + 1] != "[":
+        raise ValueError("Expected a JSON array")
+    pos += 1
+
+    while True:
+        while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] == ","):
+            pos += 1
+
+        if pos < len(buffer) and buffer[pos] == "]":
+            return
+
+        try:
+            if pos == len(buffer):
+                raise json.JSONDecodeError("Incomplete item", buffer, pos)
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # Grow the buffer geometrically, so that large items are not
+            # repeatedly parsed from the start
+            more = fs.read(max(READ_SIZE, len(buffer) - pos))
+            eof = not more
+            buffer = buffer[pos:] + more
+            pos = 0
+            continue
+
+        yield item, buffer[pos:end]
+        pos = end
+
+
+def iter_ndjson_items(
+    path: Path,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> Iterator[Tuple[Dict[str, Any], str]]:
+    """Parse the lines of an NDJSON file starting within a range of bytes."""
+    if path.suffix != ".ndjson":
+        with open_compressed(path, "r") as fs:
+            for line in fs:
+                if line.strip():
+                    yield json.loads(line), line.rstrip("\r\n")
+        return
+
+    with open(path, "rb") as fb:
+        if start:
+            # Skip the line in progress, it belongs to the previous range
+            fb.seek(start - 1)
+            fb.readline()
+
+        while end is None or fb.tell() < end:
+            data = fb.readline()
+            if not data:
+                break
+            line = data.decode("utf-8").rstrip("\r\n")
+            if line.strip():
+                yield json.loads(line), line
+
+
+def read_snapshot_items(
+    path: Path,
+    start: int = 0,
+    end: Optional[int] = None,
+) -> Iterator[Tuple[Dict[str, Any], str]]:
+    """Read the items within a saved file, along with their original text."""
+    if ".ndjson" in path.suffixes:
+        yield from iter_ndjson_items(path, start, end)
+    else:
+        with open_compressed(path, "r") as fs:
+            yield from iter_json_items(fs)
+
+
+def snapshot_tasks(files: List[Path]) -> List[SnapshotTask]:
+    """Split saved files into units of work for loading in parallel.
+
+    Uncompressed NDJSON files can be read from any line, so are split into
+    ranges of TASK_SIZE bytes. Other files are loaded whole.
+    """
+    tasks: List[SnapshotTask] = []
+    for file in files:
+        if file.suffix == ".ndjson":
+            size = file.stat().st_size
+            for start in range(0, size, TASK_SIZE):
+                tasks.append((str(file), start, min(start + TASK_SIZE, size)))
+        else:
+            tasks.append((str(file), 0, None))
+    return tasks
+
+
+def load_snapshot_task(
+    task: SnapshotTask,
+) -> Tuple[List[Resource], Dict[str, List[int]]]:
+    file, start, end = task
+    path = Path(file)
+    plural = path.name.split(".")[0]
+
+    resources: List[Resource] = []
+    items = read_snapshot_items(path, start, end)
+    for (apiVersion, kind), group in groupby(
+        items,
+        key=lambda x: (x[0]["apiVersion"], x[0]["kind"]),
+    ):
+        pairs = list(group)
+        resources += Resource.from_list_items(
+            apiVersion,
+            kind,
+            plural,
+            (item for item, _ in pairs),
+            (raw for _, raw in pairs),
+        )
+    # Returned with the resources, as tasks may run in another process
+    return resources, trim_report.take()
+
+
+def use_snapshot_metadata(metadata: Dict[str, Any]) -> None:
+    """Answer cluster metadata lookups from a download, rather than the cluster."""
+    from icekube import icekube, kube
+
+    kube.kube_version = lambda: cast(str, metadata["kube_version"])
+    kube.context_name = lambda: cast(str, metadata["context_name"])
+    kube.api_versions = lambda: cast(List[str], metadata["api_versions"])
+    kube.preferred_versions = metadata["preferred_versions"]
+    kube.api_resources = lambda: cast(
+        List[APIResource],
+        [APIResource(**x) for x in metadata["api_resources"]],
+    )
+
+    icekube.api_resources = kube.api_resources
+    icekube.context_name = kube.context_name
+    icekube.kube_version = kube.kube_version
+
+    clear_resource_refs()
+
+
+def init_loader(metadata: Dict[str, Any], settings: Config) -> None:
+    """Set up a loader process, which may not have inherited the config."""
+    config.update(settings)
+    use_snapshot_metadata(metadata)
+
+
+def load_snapshot(
+    path: Path,
+    metadata: Dict[str, Any],
+    processes: Optional[int] = None,
+    kinds: Optional[List[str]] = None,
+    namespaces: Optional[List[str]] = None,
+) -> Iterator[Resource]:
+    """Load resources from a download, optionally only of some kinds/namespaces.
+
+    Pack files are read directly through their index. Otherwise files are parsed
+    across a pool of processes, and resources are yielded as each unit of work
+    completes, so the order across files is not preserved.
+    """
+    if (path / PACK_NAME).exists():
+        with PackedSnapshot(path / PACK_NAME) as pack:
+            for entry in tqdm(list(pack.select(kinds, namespaces))):
+                yield pack.resource(entry)
+        return
+
+    def selected(
+        result: Tuple[List[Resource], Dict[str, List[int]]],
+    ) -> Iterator[Resource]:
+        resources, trimmed = result
+        trim_report.merge(trimmed)
+        for resource in resources:
+            if kinds and resource.kind not in kinds:
+                continue
+            if namespaces and resource.namespace not in namespaces:
+                continue
+            yield resource
+
+    tasks = snapshot_tasks(snapshot_files(path))
+
+    if processes == 1:
+        for task in tqdm(tasks):
+            yield from selected(load_snapshot_task(task))
+        return
+
+    with multiprocessing.Pool(
+        processes,
+        initializer=init_loader,
+        # Processes are spawned, rather than forked, on some platforms
+        initargs=(metadata, config),
+    ) as pool:
+        for result in tqdm(
+            pool.imap_unordered(load_snapshot_task, tasks),
+            total=len(tasks),
+        ):
+            yield from selected(result)
@@ -0,0 +1,114 @@
+"""Trimming of fields that IceKube never reads from raw resources.
+
+Fields are removed from each item as it is listed, before its raw JSON is
+saved, following a profile of paths for its kind. The paths under `*` apply to
+every kind. Further paths can be given per kind with `--trim-profiles`.
+"""
+
+from __future__ import annotations
+
+import json
+from typing import Any, Dict, List
+
+from icekube.config import config
+
+# Paths to fields, as the keys leading to them, that are not read by any model
+# or attack path, by kind
+DEFAULT_PROFILES: Dict[str, List[List[str]]] = {
+    "*": [
+        ["metadata", "managedFields"],
+        [
+            "metadata",
+            "annotations",
+            "kubectl.kubernetes.io/last-applied-configuration",
+        ],
+        ["status"],
+    ],
+}
+
+
+def load_profiles(path: str) -> Dict[str, List[List[str]]]:
+    """Load profiles from a JSON file, mapping kinds to lists of paths."""
+    profiles = json.load(open(path))
+    error = ValueError(f"{path} must map kinds to lists of paths, each of keys")
+    if not isinstance(profiles, dict):
+        raise error
+    for paths in profiles.values():
+        if not isinstance(paths, list):
+            raise error
+        for x in paths:
+            if not x or not isinstance(x, list):
+                raise error
+            if not all(isinstance(key, str) for key in x):
+                raise error
+    return profiles
+
+
+def trim_paths(kind: str) -> List[List[str]]:
+    """The paths to remove from resources of a kind."""
+    if not config["trim"]:
+        return []
+
+    paths: List[List[str]] = []
+    for profiles in [DEFAULT_PROFILES, config["trim_profiles"]]:
+        paths += profiles.get("*", []) + profiles.get(kind, [])
+    return paths
+
+
+def trim_item(item: Dict[str, Any], paths: List[List[str]]) -> int:
+    """Remove the paths from an item, returning roughly the bytes removed."""
+    removed = 0
+    for path in paths:
+        parent: Any = item
+        for key in path[:-1]:
+            parent = parent.get(key) if isinstance(parent, dict) else None
+        if isinstance(parent, dict) and path[-1] in parent:
+            value = parent.pop(path[-1])
+            # The key, the value and the separators around them
+            removed += len(json.dumps(value, default=str)) + len(path[-1]) + 4
+    return removed
+
+
+def format_size(size: float) -> str:
+    for unit in ["B", "KB", "MB"]:
+        if size < 1000:
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1000
+    return f"{size:.1f} GB"
+
+
+class TrimReport:
+    """The bytes of raw JSON saved by trimming, by kind."""
+
+    def __init__(self) -> None:
+        self.saved: Dict[str, List[int]] = {}
+
+    def record(self, kind: str, resources: int, saved: int) -> None:
+        totals = self.saved.setdefault(kind, [0, 0])
+        totals[0] += resources
+        totals[1] += saved
+
+    def take(self) -> Dict[str, List[int]]:
+        """The totals recorded so far, which are then reset."""
+        saved, self.saved = self.saved, {}
+        return saved
+
+    def merge(self, saved: Dict[str, List[int]]) -> None:
+        """Add totals recorded elsewhere, such as by another process."""
+        for kind, (resources, size) in saved.items():
+            self.record(kind, resources, size)
+
+    def report(self) -> None:
+        if not self.saved:
+            return
+
+        total = sum(x[1] for x in self.saved.values())
+        print(f"Trimmed {format_size(total)} of unused fields from resources")
+        for kind, (resources, saved) in sorted(
+            self.saved.items(),
+            key=lambda x: -x[1][1],
+        ):
+            print(f"  {kind}: {format_size(saved)} from {resources} resources")
+
+
+trim_report = TrimReport()
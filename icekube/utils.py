@@ -1,4 +1,6 @@
 import re
+from pathlib import PurePosixPath
+from typing import Any, Dict, Iterable
 
 
 def to_camel_case(string: str) -> str:
@@ -6,3 +8,27 @@ def to_camel_case(string: str) -> str:
     string = re.sub(r"([a-z\d])([A-Z])", r"\1_\2", string)
     string = string.replace("-", "_")
     return string.lower()
+
+
+class PathTrie:
+    """A set of paths, split into a tree of their components."""
+
+    def __init__(self, paths: Iterable[str]):
+        self.root: Dict[str, Any] = {}
+        for path in paths:
+            node = self.root
+            for part in PurePosixPath(path).parts:
+                node = node.setdefault(part, {})
+
+    def covers(self, path: str) -> bool:
+        """Whether `path` is one of the paths, or a parent directory of one."""
+        parts = PurePosixPath(path).parts
+        if not parts:
+            return False
+
+        node = self.root
+        for part in parts:
+            if part not in node:
+                return False
+            node = node[part]
+        return True